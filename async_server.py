@@ -0,0 +1,191 @@
+import asyncio
+import time
+
+from framing import FrameDecoder, RECV_SIZE
+from outbound import AsyncOutbound
+from ratelimit import CONGESTION_DELAY, DRAIN_BATCH
+from server import SecureChatServer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class StreamConnection:
+    """Adaptador para que un StreamWriter se use como un socket en SecureChatServer"""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def send(self, data):
+        if self.writer.is_closing():
+            raise ConnectionError('Conexion cerrada')
+        # write() no bloquea: los bytes quedan en el buffer del transporte
+        self.writer.write(data)
+        return len(data)
+
+    sendall = send
+
+    def setsockopt(self, *args):
+        self.writer.get_extra_info('socket').setsockopt(*args)
+
+    def shutdown(self, how=None):
+        # Descarta lo pendiente y despierta al lector con EOF
+        self.writer.transport.abort()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncSecureChatServer(SecureChatServer):
+    """Motor basado en asyncio: todas las conexiones comparten un solo event loop.
+
+    Usa el mismo handshake (SecureChatServer.handshake) y formato de mensaje
+    que handle_client, pero cada cliente ocupa una corrutina en lugar de un
+    hilo del sistema operativo.
+    """
+
+    def __init__(self, *args, backlog=1024, **kwargs):
+        super().__init__(*args, backlog=backlog, **kwargs)
+        self.loop = None
+        self.drain_handle = None  # Próxima pasada del planificador
+        self.drain_at = None
+
+    def create_outbound(self, conn, client):
+        return AsyncOutbound(
+            conn.writer,
+            lambda message: self.seal_for(client, message),
+            maxsize=self.outbound_maxsize,
+            on_failure=lambda reason: self.drop_connection(client, reason),
+            policy=self.slow_consumer_policy,
+            max_bytes=self.outbound_max_bytes
+        )
+
+    async def handle_stream(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        conn = StreamConnection(writer)
+        session_id = None
+        deadline = self.handshake_deadline(conn, addr)
+        try:
+            print(f'[+] Nueva conexion de {addr}')
+            established = await self.run_handshake(reader, conn)
+            if established is None:
+                return
+            session_id, session_key, gateway = established
+            self.timers.cancel(deadline)
+
+            # Agregar cliente a la lista
+            self.add_client(conn, addr, session_id, session_key, gateway)
+
+            # Comunicación segura: cada lectura puede traer varias tramas
+            decoder = FrameDecoder()
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+
+                for encrypted_data in decoder.feed(data):
+                    while self.sender_backlogged(session_id):
+                        # Sin leer más, TCP frena al emisor hasta que se atiendan sus mensajes
+                        await asyncio.sleep(CONGESTION_DELAY)
+                    self.process_message(session_id, session_key, encrypted_data)
+
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            print(f'[-] Error con {addr}: {e}')
+        finally:
+            self.timers.cancel(deadline)
+            if session_id:
+                self.close_session(session_id)
+            conn.close()
+
+    async def run_handshake(self, reader, conn):
+        """Conduce handshake() desde la corrutina; PBKDF2 se espera sin bloquear el loop"""
+        steps = self.handshake(conn)
+        reply = None
+        try:
+            while True:
+                step = steps.send(reply)
+                if isinstance(step, int):
+                    reply = await reader.readexactly(step)
+                else:
+                    reply = await asyncio.wrap_future(step)
+        except StopIteration as done:
+            return done.value
+        except asyncio.IncompleteReadError:
+            raise ConnectionError('Conexion cerrada durante la lectura')
+
+    def start_timers(self):
+        # Los temporizadores corren en el event loop, como el resto del estado
+        def tick():
+            self.timers.advance()
+            self.loop.call_later(self.timers.tick, tick)
+
+        self.loop.call_later(self.timers.tick, tick)
+
+    def wake_scheduler(self, delay):
+        # El planificador corre en el event loop: basta con programar su próxima pasada
+        due = self.loop.time() + delay
+        if self.drain_at is not None and self.drain_at <= due:
+            return
+        if self.drain_handle:
+            self.drain_handle.cancel()
+        self.drain_at = due
+        self.drain_handle = self.loop.call_at(due, self.drain_scheduler)
+
+    def drain_scheduler(self):
+        self.drain_handle = self.drain_at = None
+        for _ in range(DRAIN_BATCH):
+            job, wait = self.scheduler.next(time.monotonic())
+            if job is None:
+                break
+            self.run_scheduled(job)
+        else:
+            wait = 0  # Quedan turnos: siguen después de atender a los lectores
+        if wait is not None:
+            self.wake_scheduler(wait)
+
+    def call_in_server(self, callback, *args):
+        # Las colas de salida solo se tocan desde el hilo del event loop
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    async def serve(self):
+        raise_fd_limit()
+        self.loop = asyncio.get_running_loop()
+        if self.bus:
+            self.bus.start(self)
+        self.start_timers()
+        server = await asyncio.start_server(
+            self.handle_stream, self.host, self.port,
+            backlog=self.backlog, reuse_address=True, reuse_port=self.reuse_port or None
+        )
+        print(f'[+] Servidor de chat grupal (asyncio) escuchando en {self.host}:{self.port}')
+        print(f'[+] Los mensajes se reenvían entre clientes')
+        async with server:
+            await server.serve_forever()
+
+    def start_server(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print('\n[+] Cerrando servidor...')
+            print(f'[+] Desconectando {len(self.clients)} clientes...')
+        finally:
+            self.handshake_pool.shutdown()
+            if self.history:
+                self.history.close()
+
+
+def raise_fd_limit():
+    """Sube el límite de descriptores abiertos al máximo permitido (10k+ conexiones)"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        target = hard if hard != resource.RLIM_INFINITY else 65536
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            pass
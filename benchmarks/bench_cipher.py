@@ -0,0 +1,50 @@
+"""Micro-benchmark del XOR Vernam: implementación original vs. cipher.py
+
+Uso: python benchmarks/bench_cipher.py [--number N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cipher  # noqa: E402
+
+SIZES = [('64 B', 64), ('1 KB', 1024), ('64 KB', 64 * 1024)]
+
+
+def legacy_vernam(data, key):
+    """Implementación byte a byte que usaban server.py, client.py y web-server.py"""
+    return bytes([data[i] ^ key[i % len(key)] for i in range(len(data))])
+
+
+def bench(func, data, key, number):
+    best = min(timeit.repeat(lambda: func(data, key), number=number, repeat=5))
+    return best / number * 1e6  # microsegundos por llamada
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=100)
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    numpy_state = 'sí' if cipher.numpy is not None else 'no'
+    print(f'NumPy disponible: {numpy_state} (umbral {cipher.NUMPY_THRESHOLD} bytes)')
+    print(f"{'Tamaño':>8} {'original (us)':>15} {'cipher.py (us)':>15} {'aceleración':>12}")
+
+    for label, size in SIZES:
+        data = os.urandom(size)
+        if legacy_vernam(data, key) != cipher.vernam_encrypt_decrypt(data, key):
+            raise SystemExit(f'Salida distinta para {label}')
+
+        # Menos repeticiones cuanto mayor el payload
+        number = max(5, args.number * 1024 // size)
+        legacy = bench(legacy_vernam, data, key, number)
+        fast = bench(cipher.vernam_encrypt_decrypt, data, key, number)
+        print(f'{label:>8} {legacy:15.2f} {fast:15.2f} {legacy / fast:11.1f}x')
+
+
+if __name__ == '__main__':
+    main()
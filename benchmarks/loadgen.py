@@ -0,0 +1,363 @@
+"""Generador de carga y benchmark de latencia para SecureChatServer
+
+Levanta un servidor local, abre N conexiones con el protocolo de
+SecureChatClient, envía mensajes a un ritmo fijo y mide el tiempo de
+conexión/handshake, los mensajes por segundo y la latencia extremo a
+extremo del broadcast (p50/p95/p99). Los resultados se guardan en JSON
+para comparar versiones.
+
+Uso:
+    python benchmarks/loadgen.py --clients 50 --rate 200 --duration 10 \\
+        --engine asyncio --output resultados.json
+    python benchmarks/loadgen.py ... --compare resultados_anteriores.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import selectors
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from client import SecureChatClient  # noqa: E402
+from framing import FrameDecoder, RECV_SIZE  # noqa: E402
+from protocol import decode_control  # noqa: E402
+
+BENCH_TAG = 'bench'
+
+
+def percentile(values, fraction):
+    """Percentil por rango más cercano sobre una lista ordenada"""
+    if not values:
+        return None
+    rank = math.ceil(fraction * len(values))
+    return values[max(0, rank - 1)]
+
+
+def summarize(values, scale=1000.0):
+    """p50/p95/p99/max en milisegundos"""
+    ordered = sorted(values)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'p50_ms': percentile(ordered, 0.50) * scale,
+        'p95_ms': percentile(ordered, 0.95) * scale,
+        'p99_ms': percentile(ordered, 0.99) * scale,
+        'max_ms': ordered[-1] * scale,
+        'mean_ms': sum(ordered) / len(ordered) * scale,
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(port, engine, extra_args):
+    command = [sys.executable, os.path.join(ROOT, 'server.py'),
+               '--host', '127.0.0.1', '--port', str(port), '--engine', engine] + extra_args
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'El servidor terminó al arrancar (código {process.returncode})')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise SystemExit('El servidor no empezó a escuchar a tiempo')
+
+
+class BenchClient:
+    """Un SecureChatClient sin interfaz: solo handshake, envío y lectura"""
+
+    def __init__(self, index, port):
+        self.index = index
+        self.client = SecureChatClient(server_port=port)
+        self.decoder = FrameDecoder()
+        self.send_lock = threading.Lock()
+        self.conn = None
+        self.connect_time = None
+        self.handshake_time = None
+
+    def connect(self):
+        started = time.perf_counter()
+        conn = socket.create_connection((self.client.server_host, self.client.server_port))
+        connected = time.perf_counter()
+        if not self.client.establish_secure_session(conn):
+            conn.close()
+            raise ConnectionError('handshake rechazado')
+        self.connect_time = connected - started
+        self.handshake_time = time.perf_counter() - connected
+        conn.settimeout(5.0)
+        self.conn = conn
+        self.client.conn = conn
+
+    def send(self, text):
+        with self.send_lock:
+            self.conn.sendall(self.client.encrypt_message(text.encode('utf-8')))
+
+    def read(self):
+        """Devuelve los textos recibidos en una lectura (sin bloquear si hay datos)"""
+        data = self.conn.recv(RECV_SIZE)
+        if not data:
+            raise ConnectionError('conexion cerrada')
+        texts = []
+        for frame in self.decoder.feed(data):
+            decrypted = self.client.decrypt_message(frame)
+            if decrypted is None or decode_control(decrypted) is not None:
+                continue
+            texts.append(decrypted.decode('utf-8', errors='replace'))
+        return texts
+
+
+class LoadRun:
+    def __init__(self, args, port):
+        self.args = args
+        self.port = port
+        self.clients = []
+        self.latencies = []
+        self.received = 0
+        self.acks = 0
+        self.sent = 0
+        self.errors = 0
+        self.running = True
+        self.selector = selectors.DefaultSelector()
+
+    def connect_all(self):
+        clients = [BenchClient(index, self.port) for index in range(self.args.clients)]
+
+        def connect(bench_client):
+            try:
+                bench_client.connect()
+                return bench_client
+            except OSError as e:
+                print(f'[-] Cliente {bench_client.index}: {e}')
+                return None
+
+        started = time.perf_counter()
+        # Se silencian los avisos de conexión de cada SecureChatClient
+        with contextlib.redirect_stdout(io.StringIO()), \
+                ThreadPoolExecutor(max_workers=self.args.connect_concurrency) as executor:
+            self.clients = [c for c in executor.map(connect, clients) if c is not None]
+        self.connect_elapsed = time.perf_counter() - started
+
+        for bench_client in self.clients:
+            self.selector.register(bench_client.conn, selectors.EVENT_READ, bench_client)
+
+    def reader(self):
+        """Un solo hilo lee de todos los sockets"""
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.2):
+                bench_client = key.data
+                try:
+                    texts = bench_client.read()
+                except (OSError, ConnectionError):
+                    self.selector.unregister(key.fileobj)
+                    self.errors += 1
+                    continue
+                now = time.perf_counter()
+                for text in texts:
+                    self.record(text, now)
+
+    def record(self, text, now):
+        if text.startswith('Tu mensaje fue enviado'):
+            self.acks += 1
+            return
+        # "[HH:MM:SS] remitente: bench <seq> <t_envio> <relleno>"
+        marker = f': {BENCH_TAG} '
+        position = text.find(marker)
+        if position < 0:
+            return
+        fields = text[position + len(marker):].split(' ', 2)
+        try:
+            sent_at = float(fields[1])
+        except (IndexError, ValueError):
+            return
+        self.received += 1
+        self.latencies.append(now - sent_at)
+
+    def sender(self):
+        """Envía a ritmo constante repartiendo los mensajes entre los clientes"""
+        interval = 1.0 / self.args.rate
+        padding = 'x' * max(0, self.args.size)
+        deadline = time.perf_counter() + self.args.duration
+        next_send = time.perf_counter()
+        sequence = 0
+
+        while time.perf_counter() < deadline:
+            now = time.perf_counter()
+            if now < next_send:
+                time.sleep(next_send - now)
+            bench_client = self.clients[sequence % len(self.clients)]
+            try:
+                bench_client.send(f'{BENCH_TAG} {sequence} {time.perf_counter():.9f} {padding}')
+                self.sent += 1
+            except OSError:
+                self.errors += 1
+            sequence += 1
+            next_send += interval
+
+    def run(self):
+        self.connect_all()
+        if len(self.clients) < 2:
+            raise SystemExit('Se necesitan al menos 2 clientes conectados')
+
+        reader_thread = threading.Thread(target=self.reader, daemon=True)
+        reader_thread.start()
+        # Dejar que lleguen los avisos de conexión antes de medir
+        time.sleep(self.args.settle)
+
+        started = time.perf_counter()
+        self.sender()
+        send_elapsed = time.perf_counter() - started
+
+        expected = self.sent * (len(self.clients) - 1)
+        drain_deadline = time.perf_counter() + self.args.drain
+        while self.received < expected and time.perf_counter() < drain_deadline:
+            time.sleep(0.05)
+        total_elapsed = time.perf_counter() - started
+
+        self.running = False
+        reader_thread.join(timeout=2)
+        for bench_client in self.clients:
+            bench_client.conn.close()
+
+        return {
+            'clients_requested': self.args.clients,
+            'clients_connected': len(self.clients),
+            'connect_total_s': self.connect_elapsed,
+            'tcp_connect': summarize([c.connect_time for c in self.clients]),
+            'handshake': summarize([c.handshake_time for c in self.clients]),
+            'sent': self.sent,
+            'send_rate_msgs_s': self.sent / send_elapsed if send_elapsed else 0.0,
+            'expected_deliveries': expected,
+            'delivered': self.received,
+            'delivery_ratio': self.received / expected if expected else 0.0,
+            'delivered_msgs_s': self.received / total_elapsed if total_elapsed else 0.0,
+            'acks': self.acks,
+            'errors': self.errors,
+            'broadcast_latency': summarize(self.latencies),
+        }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(results):
+    metrics = results['metrics']
+    print(f"[+] Clientes conectados: {metrics['clients_connected']}/{metrics['clients_requested']} "
+          f"en {metrics['connect_total_s']:.2f} s")
+    for name in ('tcp_connect', 'handshake', 'broadcast_latency'):
+        summary = metrics[name]
+        if summary['count']:
+            print(f"[+] {name:18} p50 {summary['p50_ms']:8.2f} ms  p95 {summary['p95_ms']:8.2f} ms  "
+                  f"p99 {summary['p99_ms']:8.2f} ms  max {summary['max_ms']:8.2f} ms")
+    print(f"[+] Enviados: {metrics['sent']} ({metrics['send_rate_msgs_s']:.1f} msg/s)  "
+          f"Entregados: {metrics['delivered']}/{metrics['expected_deliveries']} "
+          f"({metrics['delivered_msgs_s']:.1f} msg/s)  Errores: {metrics['errors']}")
+
+
+def print_comparison(results, baseline):
+    """Diferencias de las métricas principales respecto a una ejecución anterior"""
+    print(f"[+] Comparación con {baseline.get('revision') or 'ejecución anterior'}:")
+    rows = [
+        ('handshake p50', ('handshake', 'p50_ms')),
+        ('latencia p50', ('broadcast_latency', 'p50_ms')),
+        ('latencia p95', ('broadcast_latency', 'p95_ms')),
+        ('latencia p99', ('broadcast_latency', 'p99_ms')),
+        ('entregados msg/s', ('delivered_msgs_s',)),
+    ]
+    for label, path in rows:
+        current, previous = results['metrics'], baseline['metrics']
+        for key in path:
+            current = current.get(key) if isinstance(current, dict) else None
+            previous = previous.get(key) if isinstance(previous, dict) else None
+        if current is None or previous is None:
+            continue
+        change = (current - previous) / previous * 100 if previous else 0.0
+        print(f'    {label:18} {previous:10.2f} -> {current:10.2f} ({change:+.1f}%)')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=20, help='conexiones simultáneas')
+    parser.add_argument('--rate', type=float, default=50, help='mensajes por segundo (total)')
+    parser.add_argument('--duration', type=float, default=10, help='segundos enviando')
+    parser.add_argument('--size', type=int, default=64, help='bytes de relleno por mensaje')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--connect-concurrency', type=int, default=16,
+                        help='handshakes simultáneos al conectar')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='segundos de espera entre conectar y empezar a medir')
+    parser.add_argument('--drain', type=float, default=5.0,
+                        help='segundos máximos esperando entregas pendientes al final')
+    parser.add_argument('--output', help='archivo JSON con los resultados')
+    parser.add_argument('--compare', help='JSON de una ejecución anterior para comparar')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help='argumentos extra para server.py (tras --)')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    server_args = [arg for arg in args.server_args if arg != '--']
+    port = free_port()
+
+    print(f'[+] Servidor local ({args.engine}) en el puerto {port}')
+    server = spawn_server(port, args.engine, server_args)
+    try:
+        metrics = LoadRun(args, port).run()
+    finally:
+        server.terminate()
+        server.wait(timeout=5)
+
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'clients': args.clients,
+            'rate': args.rate,
+            'duration': args.duration,
+            'size': args.size,
+            'engine': args.engine,
+            'server_args': server_args,
+        },
+        'metrics': metrics,
+    }
+
+    print_report(results)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f'[+] Resultados guardados en {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import hashlib
+import hmac
+
+try:
+    import numpy
+except ImportError:  # NumPy es opcional
+    numpy = None
+
+# A partir de este tamaño la ruta NumPy es más rápida que el XOR con enteros
+NUMPY_THRESHOLD = 16 * 1024
+
+MASTER_KEY = b'Luciernagas_GlobalFinance_2024'
+PBKDF2_ITERATIONS = 100000
+
+NONCE_SIZE = 8
+HMAC_SIZE = 32
+ENVELOPE_HEADER_SIZE = NONCE_SIZE + HMAC_SIZE
+
+
+def keystream(key, length):
+    """Repite la clave hasta cubrir length bytes"""
+    repeats = -(-length // len(key))
+    return (key * repeats)[:length]
+
+
+def vernam_encrypt_decrypt(data, key):
+    """XOR de todo el buffer con la clave repetida.
+
+    Produce exactamente los mismos bytes que el XOR byte a byte
+    data[i] ^ key[i % len(key)], pero en una sola operación.
+    """
+    length = len(data)
+    if not length:
+        return b''
+    stream = keystream(key, length)
+
+    if numpy is not None and length >= NUMPY_THRESHOLD:
+        return numpy.bitwise_xor(
+            numpy.frombuffer(data, dtype=numpy.uint8),
+            numpy.frombuffer(stream, dtype=numpy.uint8)
+        ).tobytes()
+
+    mixed = int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')
+    return mixed.to_bytes(length, 'big')
+
+
+def derive_key(password, salt):
+    return hashlib.pbkdf2_hmac('sha256', password, salt, PBKDF2_ITERATIONS, 32)
+
+
+def compute_hmac(key, message):
+    return hmac.new(key, message, hashlib.sha256).digest()
+
+
+def verify_hmac(message, received_hmac, key):
+    return hmac.compare_digest(compute_hmac(key, message), received_hmac)
+
+
+def seal(message, key, nonce):
+    """Cifra y autentica: [Nonce: 8 bytes][HMAC: 32 bytes][Mensaje Cifrado]"""
+    encrypted = vernam_encrypt_decrypt(message, key)
+    return nonce.to_bytes(NONCE_SIZE, 'big') + compute_hmac(key, encrypted) + encrypted
+
+
+def unseal(envelope, key):
+    """Verifica y descifra un sobre. Devuelve (nonce, mensaje) o None si no es válido"""
+    if len(envelope) < ENVELOPE_HEADER_SIZE:
+        return None
+
+    nonce = int.from_bytes(envelope[:NONCE_SIZE], 'big')
+    received_hmac = envelope[NONCE_SIZE:ENVELOPE_HEADER_SIZE]
+    encrypted = envelope[ENVELOPE_HEADER_SIZE:]
+
+    if not verify_hmac(encrypted, received_hmac, key):
+        return None
+    return nonce, vernam_encrypt_decrypt(encrypted, key)
+
+
+def hkdf(key, salt, info, length=32):
+    """HKDF-SHA256 (RFC 5869): derivación barata a partir de material ya secreto"""
+    prk = hmac.new(salt or b'\x00' * 32, key, hashlib.sha256).digest()
+    output = b''
+    block = b''
+    counter = 1
+    while len(output) < length:
+        block = hmac.new(prk, block + info + bytes([counter]), hashlib.sha256).digest()
+        output += block
+        counter += 1
+    return output[:length]
@@ -1,86 +1,468 @@
+import argparse
 import socket
-import hashlib
-import hmac
 import os
 import sys
 import threading
 import time
 
+from cipher import MASTER_KEY, derive_key, seal, unseal
+from compression import FEATURE as LZ4_FEATURE
+from compression import available as lz4_available, compress_payload, decompress_payload
+from filetransfer import FEATURE as FILE_FEATURE, IncomingFile, OutgoingTransfer
+from filetransfer import is_chunk, parse_chunk, safe_name, stream_file
+from framing import FrameDecoder, RECV_SIZE, encode_frame, recv_exact
+from groupkeys import is_group_envelope, open_group_envelope, remember_key
+from handshake import BUSY_MARKER, HANDSHAKE_TIMEOUT, RESUME_MARKER, RESUME_REJECTED
+from presence import FEATURE as PRESENCE_FEATURE, format_roster
+from protocol import decode_control, encode_control
+from tickets import resumed_session_key, ticket_secret
+
+# Intentos de reconexión tras perder la conexión con el servidor
+RECONNECT_ATTEMPTS = 5
+
+# Modo masivo: mensajes sin confirmar en vuelo y espera final de las confirmaciones
+BULK_WINDOW = 256
+BULK_ACK_TIMEOUT = 10.0
+WELCOME_TIMEOUT = 5.0
+# Comandos que el servidor no confirma
+UNACKED_COMMANDS = ('/join', '/leave', '/history', '/users')
+
+# Carpeta donde se guardan los archivos recibidos, bytes que pueden estar
+# descargándose a la vez y descargas simultáneas. Las ofertas que no entran
+# se rechazan: nadie de la sala puede llenar el disco con muchos envíos
+DOWNLOAD_DIR = 'descargas'
+DOWNLOAD_QUOTA = 256 * 1024 * 1024
+MAX_DOWNLOADS = 4
+
+
+class AckTracker:
+    """Mensajes enviados sin esperar, emparejados con su 'ack' por nonce"""
+
+    def __init__(self, window=BULK_WINDOW):
+        self.window = window
+        self.pending = {}  # nonce -> instante de envío
+        self.latencies = []
+        self.lost = 0  # Pendientes al perder la conexión (el nonce se reinicia)
+        self.rejected = 0  # Rechazados por el límite de ritmo del servidor
+        self.last_ack = None
+        self.lock = threading.Condition()
+
+    def sent(self, nonce):
+        # Se registra antes de enviar: el ack puede llegar antes de que sendall retorne
+        with self.lock:
+            self.pending[nonce] = time.perf_counter()
+
+    def discard(self, nonce):
+        with self.lock:
+            self.pending.pop(nonce, None)
+            self.lock.notify_all()
+
+    def acked(self, nonce):
+        with self.lock:
+            started = self.pending.pop(nonce, None)
+            if started is None:
+                return
+            self.last_ack = time.perf_counter()
+            self.latencies.append(self.last_ack - started)
+            self.lock.notify_all()
+
+    def reject(self, nonce):
+        with self.lock:
+            if self.pending.pop(nonce, None) is not None:
+                self.rejected += 1
+                self.lock.notify_all()
+
+    def reset(self):
+        with self.lock:
+            self.lost += len(self.pending)
+            self.pending.clear()
+            self.lock.notify_all()
+
+    def wait_window(self, alive):
+        """Bloquea mientras haya window mensajes sin confirmar"""
+        with self.lock:
+            while len(self.pending) >= self.window and alive():
+                self.lock.wait(0.5)
+
+    def drain(self, timeout, alive):
+        """Espera las confirmaciones pendientes. Devuelve cuántas faltan"""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.pending and alive():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.lock.wait(min(remaining, 0.5))
+            return len(self.pending)
+
+    def percentile(self, fraction):
+        ordered = sorted(self.latencies)
+        return ordered[int(fraction * (len(ordered) - 1))]
+
 
 class SecureChatClient:
-    def __init__(self, server_host='127.0.0.1', server_port=65432):
+    def __init__(self, server_host='127.0.0.1', server_port=65432, download_quota=DOWNLOAD_QUOTA):
         self.server_host = server_host
         self.server_port = server_port
         self.session_key = None
         self.nonce_counter = 0
         self.receiving = True
+        self.conn = None
+        self.ticket = None  # (ticket_id, secreto, expira) para reanudar la sesión
+        self.group_keys = {}  # época -> clave de la sala actual
+        self.compression = False  # El servidor aceptó lz4 en 'welcome'
+        self.compression_offered = False  # Anunció lz4 en 'hello'; cuenta hasta 'welcome'
+        self.bulk = False  # Modo masivo: no muestra los mensajes recibidos
+        self.acks = None  # AckTracker: pide 'acks' y empareja las confirmaciones por nonce
+        self.welcomed = threading.Event()
+        # Lista local de la sala: se sincroniza con deltas versionados
+        self.roster = {}  # id -> nombre
+        self.roster_room = None
+        self.roster_version = None
+        self.roster_requested = False
+        self.roster_parts = None  # (sala y versión, próxima parte, miembros) en recepción
+        # Transferencias de archivos en curso, por id
+        self.files = False  # El servidor aceptó 'files' en 'welcome'
+        self.max_file_size = 0
+        self.outgoing = {}  # id -> OutgoingTransfer
+        self.incoming = {}  # id -> IncomingFile
+        self.download_quota = download_quota  # 0 = no recibir archivos
+        # El hilo receptor también envía ('pong'): el nonce y el envío van juntos
+        self.send_lock = threading.Lock()
         self.username = f"Usuario_{os.getpid()}"  # Nombre único para cada cliente
 
-    def vernam_encrypt_decrypt(self, data, key):
-        return bytes([data[i] ^ key[i % len(key)] for i in range(len(data))])
-
-    def derive_key(self, password, salt):
-        return hashlib.pbkdf2_hmac('sha256', password, salt, 100000, 32)
-
     def establish_secure_session(self, conn):
         try:
-            salt = conn.recv(16)
+            salt = recv_exact(conn, 16)
             client_nonce = os.urandom(16)
-            conn.send(client_nonce)
-            server_nonce = conn.recv(16)
-
-            master_key = b'Luciernagas_GlobalFinance_2024'
-            self.session_key = self.derive_key(master_key, salt + client_nonce + server_nonce)
 
-            session_id = conn.recv(8)
-            print(f'[+] Conectado al chat seguro. ID: {session_id.hex()}')
+            ticket = self.ticket if self.ticket and self.ticket[2] > time.monotonic() else None
+            if ticket:
+                # Reanudación: el servidor no vuelve a ejecutar PBKDF2
+                conn.sendall(RESUME_MARKER + ticket[0] + client_nonce)
+            else:
+                conn.sendall(client_nonce)
+            # Los tickets son de un solo uso
+            self.ticket = None
+
+            server_nonce = recv_exact(conn, 16)
+            if server_nonce == BUSY_MARKER:
+                print('[-] Servidor ocupado, intenta de nuevo en unos segundos')
+                return False
+            if server_nonce == RESUME_REJECTED:
+                print('[!] Ticket de sesion rechazado')
+                return False
+
+            if ticket:
+                self.session_key = resumed_session_key(ticket[1], salt, client_nonce, server_nonce)
+            else:
+                self.session_key = derive_key(MASTER_KEY, salt + client_nonce + server_nonce)
+            self.nonce_counter = 0
+
+            session_id = recv_exact(conn, 8)
+            mode = ' (sesion reanudada)' if ticket else ''
+            print(f'[+] Conectado al chat seguro{mode}. ID: {session_id.hex()}')
             return True
 
         except Exception as e:
             print(f'[-] Error estableciendo sesion: {e}')
             return False
 
+    def connect(self):
+        """Conecta y establece la sesión. Si el ticket es rechazado, repite con handshake completo"""
+        for _ in range(2):
+            had_ticket = self.ticket is not None
+            conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # La derivación puede esperar en la cola de handshakes del servidor
+            conn.settimeout(HANDSHAKE_TIMEOUT)
+            conn.connect((self.server_host, self.server_port))
+
+            if self.establish_secure_session(conn):
+                conn.settimeout(1.0)  # Timeout corto para verificar receiving
+                self.conn = conn
+                # Capacidades del cliente; el servidor responde con 'welcome'
+                self.group_keys = {}
+                self.compression = False
+                self.welcomed.clear()
+                if self.acks:
+                    # El nonce vuelve a empezar: los pendientes ya no se confirmarán
+                    self.acks.reset()
+                self.roster_room = self.roster_version = self.roster_parts = None
+                # El servidor olvidó las transferencias de la conexión anterior
+                self.drop_transfers('conexion perdida')
+                features = ['resume', 'group_keys', 'heartbeat', PRESENCE_FEATURE]
+                self.compression_offered = lz4_available()
+                if self.compression_offered:
+                    features.append(LZ4_FEATURE)
+                if self.acks:
+                    features.append('acks')
+                if not self.bulk:
+                    features.append(FILE_FEATURE)
+                self.send_control('hello', features=features)
+                return True
+
+            conn.close()
+            if not had_ticket:
+                break
+        return False
+
+    def reconnect(self):
+        """Reintenta la conexión tras perderla, reanudando la sesión si hay ticket"""
+        for attempt in range(RECONNECT_ATTEMPTS):
+            if not self.receiving:
+                return False
+            time.sleep(min(2 ** attempt, 10))
+            print(f'\n[!] Reconectando ({attempt + 1}/{RECONNECT_ATTEMPTS})...')
+            try:
+                if self.connect():
+                    return True
+            except OSError as e:
+                print(f'[-] Error de conexion: {e}')
+        return False
+
     def encrypt_message(self, message):
         self.nonce_counter += 1
-        encrypted = self.vernam_encrypt_decrypt(message, self.session_key)
-        message_hmac = hmac.new(self.session_key, encrypted, hashlib.sha256).digest()
-        nonce_bytes = self.nonce_counter.to_bytes(8, 'big')
-        return nonce_bytes + message_hmac + encrypted
+        if self.compression:
+            message = compress_payload(message)
+        return encode_frame(seal(message, self.session_key, self.nonce_counter))
 
     def decrypt_message(self, encrypted_data):
-        if len(encrypted_data) < 40:
-            return None
-
-        nonce = encrypted_data[:8]
-        received_hmac = encrypted_data[8:40]
-        encrypted_message = encrypted_data[40:]
-
-        expected_hmac = hmac.new(self.session_key, encrypted_message, hashlib.sha256).digest()
-        if not hmac.compare_digest(expected_hmac, received_hmac):
+        if is_group_envelope(encrypted_data):
+            # Broadcast cifrado una sola vez con la clave de la sala
+            message = open_group_envelope(encrypted_data, self.group_keys)
+        else:
+            opened = unseal(encrypted_data, self.session_key)
+            message = opened[1] if opened else None
+        # Solo una sesión que negoció lz4 recibe mensajes comprimidos. Hasta 'welcome'
+        # basta con haberlo anunciado: el servidor comprime desde que lo acepta
+        negotiated = self.compression if self.welcomed.is_set() else self.compression_offered
+        if message is None or not negotiated:
+            return message
+        try:
+            return decompress_payload(message)
+        except ValueError:
             return None
 
-        return self.vernam_encrypt_decrypt(encrypted_message, self.session_key)
-
-    def receive_messages(self, conn):
+    def send_control(self, kind, **fields):
+        self.send_message(encode_control(kind, **fields))
+
+    def send_message(self, message):
+        with self.send_lock:
+            self.conn.sendall(self.encrypt_message(message))
+
+    def handle_control(self, control):
+        """Procesa un mensaje de control del servidor"""
+        if control['type'] == 'welcome':
+            self.compression = LZ4_FEATURE in control.get('features', [])
+            self.files = FILE_FEATURE in control.get('features', [])
+            self.max_file_size = control.get('max_file_size', 0)
+            if self.acks and 'acks' not in control.get('features', []):
+                # Servidor antiguo: confirma con texto, sin nonce
+                self.acks = None
+            if control.get('ticket'):
+                ticket_id = bytes.fromhex(control['ticket'])
+                expires_at = time.monotonic() + control.get('lifetime', 0)
+                self.ticket = (ticket_id, ticket_secret(self.session_key, ticket_id), expires_at)
+            self.welcomed.set()
+        elif control['type'] == 'group_key':
+            remember_key(self.group_keys, control)
+        elif control['type'] == 'roster':
+            self.apply_roster(control)
+        elif control['type'] == 'presence':
+            self.apply_presence(control)
+        elif control['type'] == 'ping':
+            # Heartbeat: el servidor corta las sesiones que no responden
+            self.send_control('pong')
+        elif control['type'] == 'ack':
+            tracker = self.acks
+            if tracker and control.get('rejected'):
+                tracker.reject(control['nonce'])
+            elif tracker:
+                tracker.acked(control['nonce'])
+        elif control['type'].startswith('file_'):
+            self.handle_file_control(control)
+
+    def handle_file_control(self, control):
+        transfer_id = bytes.fromhex(control['id'])
+        kind = control['type']
+        if kind == 'file_ack':
+            transfer = self.outgoing.get(transfer_id)
+            if transfer:
+                transfer.ack(control['seq'])
+        elif kind == 'file_done':
+            transfer = self.outgoing.get(transfer_id)
+            if transfer:
+                transfer.finished(control['recipients'])
+        elif kind == 'file_offer':
+            size = control['size']
+            downloading = sum(incoming.size for incoming in self.incoming.values())
+            if len(self.incoming) >= MAX_DOWNLOADS or downloading + size > self.download_quota:
+                # Sin descarga abierta, sus trozos se ignoran y nada llega al disco
+                print(f"\n[!] Archivo {safe_name(control['name'])} de {control['sender']} rechazado: "
+                      f"supera la cuota de descargas\nTu: ", end="", flush=True)
+                return
+            incoming = IncomingFile(DOWNLOAD_DIR, control['name'], size, control['sender'])
+            self.incoming[transfer_id] = incoming
+        elif kind == 'file_end':
+            incoming = self.incoming.pop(transfer_id, None)
+            if incoming is None:
+                return
+            if incoming.finish(control['sha256']):
+                print(f"\n[+] Archivo {incoming.name} de {incoming.sender} guardado en {incoming.path}\nTu: ",
+                      end="", flush=True)
+            else:
+                print(f"\n[!] Archivo {incoming.name} descartado: no coincide el SHA-256\nTu: ", end="", flush=True)
+        elif kind == 'file_abort':
+            reason = control.get('reason', 'cancelado')
+            transfer = self.outgoing.get(transfer_id)
+            if transfer:
+                transfer.abort(reason)
+            incoming = self.incoming.pop(transfer_id, None)
+            if incoming:
+                incoming.abort()
+                print(f"\n[!] Archivo {incoming.name} cancelado: {reason}\nTu: ", end="", flush=True)
+
+    def receive_chunk(self, message):
+        """Escribe un trozo de archivo directamente en su descarga"""
+        transfer_id, seq, data = parse_chunk(message)
+        incoming = self.incoming.get(transfer_id)
+        if incoming is None:
+            return
+        try:
+            incoming.write(seq, data)
+        except ValueError as e:
+            del self.incoming[transfer_id]
+            incoming.abort()
+            print(f"\n[!] Archivo {incoming.name} descartado: {e}\nTu: ", end="", flush=True)
+
+    def drop_transfers(self, reason):
+        for transfer in list(self.outgoing.values()):
+            transfer.abort(reason)
+        for incoming in self.incoming.values():
+            incoming.abort()
+        self.incoming = {}
+
+    def send_file(self, path):
+        """Comparte un archivo con la sala en un hilo aparte; el chat sigue disponible"""
+        if not self.files:
+            print('[-] El servidor no acepta archivos')
+            return
+        try:
+            size = os.path.getsize(path)
+        except OSError as e:
+            print(f'[-] No se puede leer {path}: {e}')
+            return
+        if size > self.max_file_size:
+            print(f'[-] {path} supera el maximo de {self.max_file_size} bytes')
+            return
+        sender = threading.Thread(target=self.stream_file, args=(path, size), daemon=True)
+        sender.start()
+
+    def stream_file(self, path, size):
+        transfer = OutgoingTransfer(safe_name(path), size)
+        transfer_id = transfer.transfer_id.hex()
+        self.outgoing[transfer.transfer_id] = transfer
+        try:
+            with open(path, 'rb') as source:
+                self.send_control('file_offer', id=transfer_id, name=transfer.name, size=size)
+                sha256 = stream_file(transfer, source, self.send_message)
+            if sha256 is None:
+                # Si lo canceló el servidor ya no conoce el id y lo ignora
+                self.send_control('file_abort', id=transfer_id)
+                print(f"\n[-] Envio de {transfer.name} cancelado: {transfer.error}\nTu: ", end="", flush=True)
+                return
+            self.send_control('file_end', id=transfer_id, sha256=sha256)
+            recipients = transfer.wait_finished()
+            if recipients is None:
+                print(f"\n[-] Envio de {transfer.name} sin confirmar: {transfer.error}\nTu: ", end="", flush=True)
+            else:
+                print(f"\n[+] {transfer.name} enviado a {recipients} usuario(s)\nTu: ", end="", flush=True)
+        except OSError as e:
+            print(f"\n[-] Error enviando {transfer.name}: {e}\nTu: ", end="", flush=True)
+        finally:
+            self.outgoing.pop(transfer.transfer_id, None)
+
+    def apply_roster(self, control):
+        """Junta las partes de la lista completa; la aplica al llegar la última"""
+        part = control.get('part', 0)
+        key = (control['room'], control['version'])
+        if part == 0:
+            self.roster_parts = (key, 0, {})
+        elif self.roster_parts is None or self.roster_parts[:2] != (key, part):
+            # Falta una parte: se descarta lo recibido y se vuelve a pedir
+            self.roster_parts = None
+            if not self.roster_requested:
+                self.roster_requested = True
+                self.send_control('roster')
+            return
+        _, _, users = self.roster_parts
+        users.update((user_id, name) for user_id, name in control['users'])
+        if part + 1 < control.get('parts', 1):
+            self.roster_parts = (key, part + 1, users)
+            return
+        self.roster_parts = None
+        self.roster = users
+        self.roster_room, self.roster_version = key
+        self.roster_requested = False
+
+    def apply_presence(self, control):
+        """Aplica un delta de presencia o pide la lista completa si falta alguno"""
+        if control['room'] == self.roster_room:
+            if control['version'] <= self.roster_version:
+                return  # Ya incluido en la lista recibida
+            if control['version'] == self.roster_version + 1:
+                for user_id, name in control.get('joined', []):
+                    self.roster[user_id] = name
+                for user_id in control.get('left', []):
+                    self.roster.pop(user_id, None)
+                self.roster_version = control['version']
+                return
+        if not self.roster_requested:
+            self.roster_requested = True
+            self.send_control('roster')
+
+    def receive_messages(self):
         """Hilo para recibir mensajes en tiempo real"""
+        decoder = FrameDecoder()
         while self.receiving:
             try:
-                data = conn.recv(1024)
+                data = self.conn.recv(RECV_SIZE)
                 if not data:
-                    print("\n[!] Conexion con el servidor perdida")
-                    self.receiving = False
-                    break
-
-                decrypted = self.decrypt_message(data)
-                if decrypted:
+                    raise ConnectionError('conexion cerrada por el servidor')
+
+                for frame in decoder.feed(data):
+                    decrypted = self.decrypt_message(frame)
+                    if decrypted is None:
+                        print("\n[!] Mensaje corrupto recibido")
+                        continue
+
+                    if is_chunk(decrypted):
+                        self.receive_chunk(decrypted)
+                        continue
+                    control = decode_control(decrypted)
+                    if control is not None:
+                        self.handle_control(control)
+                        continue
+
+                    if self.bulk:
+                        continue
                     message = decrypted.decode('utf-8')
                     # Mostrar mensaje sin interrumpir la entrada
                     print(f"\n{message}\nTu: ", end="", flush=True)
-                else:
-                    print("\n[!] Mensaje corrupto recibido")
 
             except socket.timeout:
                 continue
+            except (ConnectionError, OSError) as e:
+                if not self.receiving:
+                    break
+                print(f"\n[!] Conexion con el servidor perdida: {e}")
+                self.conn.close()
+                if not self.reconnect():
+                    self.receiving = False
+                    break
+                decoder = FrameDecoder()
+                if not self.bulk:
+                    print("Tu: ", end="", flush=True)
             except Exception as e:
                 if self.receiving:
                     print(f"\n[!] Error recibiendo: {e}")
@@ -88,75 +470,198 @@ class SecureChatClient:
 
     def start_client(self):
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as conn:
-                conn.settimeout(1.0)  # Timeout corto para verificar receiving
-                print(f'[+] Conectando a {self.server_host}:{self.server_port}...')
-                conn.connect((self.server_host, self.server_port))
+            print(f'[+] Conectando a {self.server_host}:{self.server_port}...')
+            if not self.connect():
+                return
 
-                if not self.establish_secure_session(conn):
-                    return
+            # Establecer username
+            username_msg = f"/username {self.username}"
+            self.send_message(username_msg.encode('utf-8'))
 
-                # Establecer username
-                username_msg = f"/username {self.username}"
-                encrypted_username = self.encrypt_message(username_msg.encode('utf-8'))
-                conn.send(encrypted_username)
+            # Iniciar hilo para recibir mensajes
+            receive_thread = threading.Thread(target=self.receive_messages)
+            receive_thread.daemon = True
+            receive_thread.start()
 
-                # Iniciar hilo para recibir mensajes
-                receive_thread = threading.Thread(target=self.receive_messages, args=(conn,))
-                receive_thread.daemon = True
-                receive_thread.start()
+            print('\n[+] === CHAT SEGURO ACTIVO ===')
+            print('[+] Escribe tus mensajes (se enviarán a todos los de tu sala)')
+            print('[+] Comandos: /exit, /status, /users, /join <sala>, /leave, /history [N], /send <archivo>\n')
 
-                print('\n[+] === CHAT SEGURO ACTIVO ===')
-                print('[+] Escribe tus mensajes (se enviarán a todos los conectados)')
-                print('[+] Comandos: /exit, /status, /users\n')
+            while self.receiving:
+                try:
+                    message = input("Tu: ")
 
-                while self.receiving:
-                    try:
-                        message = input("Tu: ")
-
-                        if message.lower() == '/exit':
-                            self.receiving = False
-                            break
-                        elif message.lower() == '/status':
-                            print(f'[Estado] Nonce: {self.nonce_counter}')
-                            continue
-                        elif message.lower() == '/users':
-                            print('[Info] Consulta de usuarios disponible')
-                            continue
-
-                        if not message.strip():
-                            continue
-
-                        # Enviar mensaje al chat grupal
-                        encrypted = self.encrypt_message(message.encode('utf-8'))
-                        conn.send(encrypted)
-
-                        # Esperar breve confirmación
-                        time.sleep(0.1)
-
-                    except KeyboardInterrupt:
-                        print('\n[+] Desconectando...')
-                        self.receiving = False
-                        break
-                    except Exception as e:
-                        print(f'\n[-] Error: {e}')
+                    if message.lower() == '/exit':
                         self.receiving = False
                         break
+                    elif message.lower() == '/status':
+                        resume = 'disponible' if self.ticket else 'no disponible'
+                        print(f'[Estado] Nonce: {self.nonce_counter} | Reanudacion: {resume}')
+                        continue
+                    elif message.lower() == '/users' and self.roster_room is not None:
+                        # Respondido con la lista local, sin consultar al servidor
+                        print(f'[Info] {format_roster(self.roster_room, self.roster)}')
+                        continue
+                    elif message.startswith('/send '):
+                        self.send_file(message[len('/send '):].strip())
+                        continue
+
+                    if not message.strip():
+                        continue
+
+                    # Enviar mensaje al chat grupal
+                    try:
+                        self.send_message(message.encode('utf-8'))
+                    except OSError:
+                        # El hilo receptor se encarga de reconectar
+                        print('[!] Mensaje no enviado: conexion perdida')
+                        continue
+
+                    # Esperar breve confirmación
+                    time.sleep(0.1)
+
+                except KeyboardInterrupt:
+                    print('\n[+] Desconectando...')
+                    self.receiving = False
+                    break
+                except Exception as e:
+                    print(f'\n[-] Error: {e}')
+                    self.receiving = False
+                    break
 
-                print('[+] Desconectado del chat')
+            print('[+] Desconectado del chat')
 
         except ConnectionRefusedError:
             print('[-] No se pudo conectar al servidor')
         except Exception as e:
             print(f'[-] Error de conexion: {e}')
+        finally:
+            self.drop_transfers('cliente cerrado')
+            if self.conn:
+                self.conn.close()
+
+    def start_bulk(self, source, window=BULK_WINDOW, ack_timeout=BULK_ACK_TIMEOUT):
+        """Envía cada línea de source sin esperar confirmaciones y resume el rendimiento.
+
+        Las tramas se envían seguidas; las confirmaciones llegan por el hilo
+        receptor y se emparejan por nonce. Como mucho window mensajes quedan
+        sin confirmar, para no llenar la cola de salida del servidor.
+        """
+        self.bulk = True
+        self.acks = AckTracker(window)
+        try:
+            print(f'[+] Conectando a {self.server_host}:{self.server_port}...')
+            if not self.connect():
+                return
+
+            receive_thread = threading.Thread(target=self.receive_messages)
+            receive_thread.daemon = True
+            receive_thread.start()
+            if not self.welcomed.wait(WELCOME_TIMEOUT):
+                self.acks = None
+            tracker = self.acks
+            alive = lambda: self.receiving
+
+            sent = failed = bytes_sent = tracked = 0
+            started = time.perf_counter()
+            for line in source:
+                if not self.receiving:
+                    break
+                message = line.rstrip('\r\n')
+                if not message.strip():
+                    continue
+
+                confirmed = tracker and message.partition(' ')[0] not in UNACKED_COMMANDS
+                if confirmed:
+                    tracker.wait_window(alive)
+                try:
+                    with self.send_lock:
+                        frame = self.encrypt_message(message.encode('utf-8'))
+                        nonce = self.nonce_counter
+                        if confirmed:
+                            tracker.sent(nonce)
+                        self.conn.sendall(frame)
+                except OSError:
+                    # El hilo receptor se encarga de reconectar
+                    failed += 1
+                    if confirmed:
+                        tracker.discard(nonce)
+                    continue
+                sent += 1
+                tracked += bool(confirmed)
+                bytes_sent += len(frame)
+            sending_time = time.perf_counter() - started
+
+            unconfirmed = tracker.drain(ack_timeout, alive) if tracker else 0
+            self.print_bulk_summary(sent, failed, bytes_sent, tracked, unconfirmed, started, sending_time)
+
+        except ConnectionRefusedError:
+            print('[-] No se pudo conectar al servidor')
+        except Exception as e:
+            print(f'[-] Error de conexion: {e}')
+        finally:
+            self.receiving = False
+            if self.conn:
+                self.conn.close()
+
+    def print_bulk_summary(self, sent, failed, bytes_sent, tracked, unconfirmed, started, sending_time):
+        tracker = self.acks
+        # Con confirmaciones, el envío termina cuando llega la última
+        elapsed = sending_time
+        if tracker and tracker.last_ack:
+            elapsed = max(elapsed, tracker.last_ack - started)
+        elapsed = max(elapsed, 1e-9)
+
+        print('\n[+] === RESUMEN DEL ENVIO ===')
+        print(f'[+] Mensajes enviados: {sent} ({bytes_sent} bytes) en {elapsed:.2f} s')
+        print(f'[+] Rendimiento: {sent / elapsed:.0f} msg/s, {bytes_sent / elapsed / 1024:.1f} KiB/s')
+        if failed:
+            print(f'[-] No enviados por conexion perdida: {failed}')
+        if not tracker:
+            print('[!] El servidor no confirma por nonce: sin estadisticas de confirmacion')
+            return
+        confirmed = len(tracker.latencies)
+        print(f'[+] Confirmados: {confirmed}/{tracked} | sin confirmar: {unconfirmed} '
+              f'| perdidos al reconectar: {tracker.lost}')
+        if tracker.rejected:
+            print(f'[!] Rechazados por el servidor (tamano, ritmo o cola de espera llena): {tracker.rejected}')
+        if confirmed:
+            average = sum(tracker.latencies) / confirmed
+            print(f'[+] Latencia de confirmacion: media {average * 1000:.1f} ms '
+                  f'p50 {tracker.percentile(0.5) * 1000:.1f} ms '
+                  f'p99 {tracker.percentile(0.99) * 1000:.1f} ms '
+                  f'max {max(tracker.latencies) * 1000:.1f} ms')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Cliente de chat seguro')
+    parser.add_argument('host', nargs='?', default=None,
+                        help='IP del servidor de chat (por defecto, 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=65432)
+    parser.add_argument('--bulk', metavar='ARCHIVO', default=None,
+                        help="envía cada línea del archivo ('-' = stdin) sin esperar y termina")
+    parser.add_argument('--window', type=int, default=BULK_WINDOW,
+                        help='mensajes sin confirmar en vuelo en modo --bulk')
+    parser.add_argument('--ack-timeout', type=float, default=BULK_ACK_TIMEOUT,
+                        help='segundos de espera de las últimas confirmaciones en modo --bulk')
+    parser.add_argument('--download-quota', type=int, default=DOWNLOAD_QUOTA,
+                        help='bytes de archivos recibidos que pueden descargarse a la vez (0 = no recibir)')
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        server_ip = sys.argv[1]
-        print(f'[+] Usando servidor: {server_ip}')
-        client = SecureChatClient(server_host=server_ip)
+    args = parse_args()
+    if args.host:
+        print(f'[+] Usando servidor: {args.host}')
+        client = SecureChatClient(server_host=args.host, server_port=args.port,
+                                  download_quota=args.download_quota)
     else:
-        client = SecureChatClient()
+        client = SecureChatClient(server_port=args.port, download_quota=args.download_quota)
 
-    client.start_client()
\ No newline at end of file
+    if args.bulk == '-':
+        client.start_bulk(sys.stdin, args.window, args.ack_timeout)
+    elif args.bulk:
+        with open(args.bulk, encoding='utf-8') as source:
+            client.start_bulk(source, args.window, args.ack_timeout)
+    else:
+        client.start_client()
\ No newline at end of file
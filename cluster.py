@@ -0,0 +1,199 @@
+"""Modo multiproceso del servidor de chat.
+
+N workers comparten el puerto con SO_REUSEPORT y el kernel reparte las
+conexiones entre ellos. El proceso maestro mantiene un bus local sobre un
+socket Unix: cada worker publica ahí sus broadcasts y cuántos miembros
+tiene en cada sala, y el bus lo reenvía al resto de workers.
+"""
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+
+from framing import FrameDecoder, RECV_SIZE, encode_frame
+from metrics import REGISTRY
+from outbound import ThreadedOutbound
+from protocol import decode_control, encode_control
+
+# El bus es local y los mensajes pequeños: una cola generosa evita cortar
+# a un worker por una ráfaga de broadcasts
+BUS_QUEUE_SIZE = 65536
+
+BUS_MESSAGES = REGISTRY.counter('chat_bus_messages_total',
+                                'Mensajes del bus entre workers', ['direction'])
+
+
+class BusHub:
+    """Relay del proceso maestro: reenvía cada trama de un worker a los demás"""
+
+    def __init__(self, path):
+        self.path = path
+        self.workers = {}  # conexión -> (worker_id, salida)
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+
+    def start(self):
+        thread = threading.Thread(target=self.accept_workers)
+        thread.daemon = True
+        thread.start()
+
+    def accept_workers(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self.serve_worker, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def serve_worker(self, conn):
+        outbound = ThreadedOutbound(conn, lambda frame: frame, maxsize=BUS_QUEUE_SIZE,
+                                    on_failure=lambda reason: self.drop_worker(conn, reason))
+        worker_id = None
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = conn.recv(RECV_SIZE)
+                if not data:
+                    break
+                for message in decoder.feed(data):
+                    if worker_id is None:
+                        # La primera trama de cada worker es su 'hello'
+                        worker_id = decode_control(message)['worker']
+                        with self.lock:
+                            self.workers[conn] = (worker_id, outbound)
+                        continue
+                    self.forward(encode_frame(message), conn)
+        except ConnectionResetError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            print(f'[-] Error en el bus con el worker {worker_id}: {e}')
+        finally:
+            self.drop_worker(conn, 'desconectado')
+            if worker_id is not None:
+                # Sus participantes dejan de contar para los demás
+                self.forward(encode_frame(encode_control('worker_down', worker=worker_id)))
+
+    def forward(self, frame, origin=None):
+        with self.lock:
+            targets = [outbound for conn, (_, outbound) in self.workers.items() if conn is not origin]
+        for outbound in targets:
+            outbound.put(frame)
+
+    def drop_worker(self, conn, reason):
+        with self.lock:
+            entry = self.workers.pop(conn, None)
+        if entry:
+            print(f'[-] Worker {entry[0]} fuera del bus: {reason}')
+            entry[1].close()
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.sock.close()
+
+
+class BusClient:
+    """Conexión de un worker con el bus del proceso maestro"""
+
+    def __init__(self, path, worker_id):
+        self.path = path
+        self.worker_id = worker_id
+        self.conn = None
+        self.outbound = None
+        self.server = None
+
+    def start(self, server):
+        self.server = server
+        self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.conn.connect(self.path)
+        self.outbound = ThreadedOutbound(self.conn, encode_frame, maxsize=BUS_QUEUE_SIZE,
+                                         on_failure=self.lost)
+        self.outbound.put(encode_control('hello', worker=self.worker_id))
+
+        reader = threading.Thread(target=self.receive)
+        reader.daemon = True
+        reader.start()
+
+    def publish(self, kind, **fields):
+        """Encola un mensaje para los demás workers sin bloquear"""
+        if self.outbound is None:
+            return
+        BUS_MESSAGES.labels('out').inc()
+        self.outbound.put(encode_control(kind, worker=self.worker_id, **fields))
+
+    def receive(self):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = self.conn.recv(RECV_SIZE)
+                if not data:
+                    break
+                for message in decoder.feed(data):
+                    control = decode_control(message)
+                    if control is not None:
+                        BUS_MESSAGES.labels('in').inc()
+                        self.server.call_in_server(self.server.handle_bus, control)
+        except OSError as e:
+            print(f'[-] Bus del worker {self.worker_id} perdido: {e}')
+        self.lost('conexión cerrada')
+
+    def lost(self, reason):
+        if self.outbound is not None:
+            self.outbound.close()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def run_cluster(workers, start_worker):
+    """Arranca el bus y forkea workers; cada hijo ejecuta start_worker(index, bus_path)"""
+    directory = tempfile.mkdtemp(prefix='chat-bus-')
+    path = os.path.join(directory, 'bus.sock')
+    hub = BusHub(path)
+
+    children = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # El hijo no hereda hilos: solo necesita la ruta del bus
+            hub.close()
+            status = 0
+            try:
+                start_worker(index, path)
+            except BaseException as e:
+                print(f'[-] Worker {index} terminado: {e}')
+                status = 1
+            finally:
+                os._exit(status)
+        children.append(pid)
+
+    hub.start()
+    print(f'[+] {workers} workers compartiendo el puerto, bus en {path}')
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        # Con Ctrl+C la señal llega a todo el grupo; con kill solo al maestro,
+        # así que se reenvía para que cada worker cierre por su cuenta
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+    finally:
+        hub.close()
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,52 @@
+"""Compresión lz4 de mensajes grandes, negociada por sesión.
+
+Ambos extremos anuncian 'lz4' en hello/welcome. A partir de ahí, los
+mensajes de al menos COMPRESSION_THRESHOLD bytes se comprimen antes de
+cifrarlos y viajan con el prefijo COMPRESSED_PREFIX. Los mensajes cortos,
+o los que no se reducen, viajan igual que siempre.
+"""
+from framing import MAX_FRAME_SIZE
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # lz4 es opcional: sin él no se anuncia la capacidad
+    lz4_frame = None
+
+FEATURE = 'lz4'
+COMPRESSION_THRESHOLD = 512
+
+# Los controles empiezan con b'\x00'; el texto UTF-8 normal nunca con b'\x01'
+COMPRESSED_PREFIX = b'\x01'
+
+# Tope al descomprimir: lo mismo que admite una trama sin comprimir
+MAX_DECOMPRESSED_SIZE = MAX_FRAME_SIZE
+
+
+def available():
+    return lz4_frame is not None
+
+
+def compress_payload(message, threshold=COMPRESSION_THRESHOLD):
+    """Comprime message si es grande y se reduce. Solo para sesiones con lz4"""
+    escaped = message[:1] == COMPRESSED_PREFIX
+    if len(message) < threshold and not escaped:
+        return message
+    compressed = COMPRESSED_PREFIX + lz4_frame.compress(message)
+    # Un mensaje que ya empieza con el prefijo siempre va comprimido
+    if len(compressed) < len(message) or escaped:
+        return compressed
+    return message
+
+
+def decompress_payload(message):
+    """Inversa de compress_payload. Lanza ValueError si el contenido no es válido"""
+    if message[:1] != COMPRESSED_PREFIX:
+        return message
+    decompressor = lz4_frame.LZ4FrameDecompressor()
+    try:
+        plain = decompressor.decompress(message[1:], max_length=MAX_DECOMPRESSED_SIZE)
+    except RuntimeError as e:
+        raise ValueError(f'lz4 invalido: {e}')
+    if not decompressor.eof:
+        raise ValueError('mensaje comprimido incompleto o demasiado grande')
+    return plain
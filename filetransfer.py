@@ -0,0 +1,208 @@
+"""Transferencia de archivos en trozos cifrados, intercalados con el chat.
+
+Cada trozo es un mensaje más: viaja cifrado y con HMAC en su propia trama,
+así los mensajes de chat pasan entre trozo y trozo. El contenido es:
+
+    [FILE_PREFIX: 1][Id de transferencia: 8][Secuencia: 4][Datos]
+
+La transferencia se anuncia con un control 'file_offer' y termina con
+'file_end' (con el SHA-256 del archivo) o 'file_abort'. El servidor
+confirma cada trozo con 'file_ack'; el emisor tiene como mucho WINDOW
+trozos sin confirmar por transferencia.
+"""
+import hashlib
+import os
+import struct
+import threading
+
+FEATURE = 'files'
+
+# Los controles empiezan con b'\x00' y los comprimidos con b'\x01'
+FILE_PREFIX = b'\x02'
+CHUNK_HEADER = struct.Struct('!8sI')
+CHUNK_HEADER_SIZE = len(FILE_PREFIX) + CHUNK_HEADER.size
+
+CHUNK_SIZE = 32 * 1024
+WINDOW = 8
+MAX_FILE_SIZE = 64 * 1024 * 1024
+# Transferencias simultáneas de un mismo emisor
+MAX_TRANSFERS = 4
+MAX_NAME_LENGTH = 255
+
+# Segundos sin confirmaciones antes de abandonar un envío
+ACK_TIMEOUT = 30.0
+
+TRANSFER_ID_SIZE = 8
+
+# Controles que envía quien comparte un archivo
+SENDER_CONTROLS = ('file_offer', 'file_end', 'file_abort')
+
+
+def is_chunk(message):
+    return message[:1] == FILE_PREFIX
+
+
+def encode_chunk(transfer_id, seq, data):
+    return FILE_PREFIX + CHUNK_HEADER.pack(transfer_id, seq) + data
+
+
+def parse_chunk(message):
+    """Devuelve (id, secuencia, datos) sin copiar: datos es una vista del mensaje"""
+    if len(message) < CHUNK_HEADER_SIZE:
+        raise ValueError('trozo de archivo truncado')
+    transfer_id, seq = CHUNK_HEADER.unpack_from(message, len(FILE_PREFIX))
+    return transfer_id, seq, memoryview(message)[CHUNK_HEADER_SIZE:]
+
+
+def new_transfer_id():
+    return os.urandom(TRANSFER_ID_SIZE)
+
+
+def safe_name(name):
+    """Nombre de archivo sin rutas, apto para guardarlo en la carpeta de descargas"""
+    name = os.path.basename(str(name).replace('\\', '/')).strip()
+    name = ''.join(char for char in name if char.isprintable())
+    return name[:MAX_NAME_LENGTH].lstrip('.') or 'archivo'
+
+
+class OutgoingTransfer:
+    """Ventana de envío de una transferencia: bloquea al emisor sin créditos"""
+
+    def __init__(self, name, size, window=WINDOW):
+        self.transfer_id = new_transfer_id()
+        self.name = name
+        self.size = size
+        self.window = window
+        self.sent = 0  # Trozos enviados
+        self.acked = 0  # Trozos confirmados por el servidor
+        self.recipients = None  # Destinatarios, al confirmar 'file_end'
+        self.error = None
+        self.lock = threading.Condition()
+
+    def wait_credit(self, timeout=ACK_TIMEOUT):
+        """Espera a tener lugar en la ventana. Devuelve False si se abandonó"""
+        with self.lock:
+            while self.sent - self.acked >= self.window and self.error is None:
+                if not self.lock.wait(timeout):
+                    self.error = 'sin confirmaciones del servidor'
+            if self.error is None:
+                self.sent += 1
+            return self.error is None
+
+    def wait_done(self, timeout=ACK_TIMEOUT):
+        with self.lock:
+            while self.acked < self.sent and self.error is None:
+                if not self.lock.wait(timeout):
+                    self.error = 'sin confirmaciones del servidor'
+            return self.error is None
+
+    def ack(self, seq):
+        with self.lock:
+            self.acked = max(self.acked, seq + 1)
+            self.lock.notify_all()
+
+    def abort(self, reason):
+        with self.lock:
+            self.error = reason
+            self.lock.notify_all()
+
+    def finished(self, recipients):
+        with self.lock:
+            self.recipients = recipients
+            self.lock.notify_all()
+
+    def wait_finished(self, timeout=ACK_TIMEOUT):
+        """Espera 'file_done'. Devuelve los destinatarios o None"""
+        with self.lock:
+            if self.recipients is None and self.error is None:
+                self.lock.wait(timeout)
+            return self.recipients
+
+
+def stream_file(transfer, source, send, chunk_size=CHUNK_SIZE):
+    """Envía los trozos de source respetando la ventana de la transferencia.
+
+    send recibe cada trozo ya codificado. Devuelve el SHA-256 del archivo
+    cuando el servidor confirmó todos los trozos, o None si se abandonó.
+    """
+    digest = hashlib.sha256()
+    seq = 0
+    while True:
+        data = source.read(chunk_size)
+        if not data:
+            break
+        if not transfer.wait_credit():
+            return None
+        digest.update(data)
+        send(encode_chunk(transfer.transfer_id, seq, data))
+        seq += 1
+    if not transfer.wait_done():
+        return None
+    return digest.hexdigest()
+
+
+class IncomingFile:
+    """Archivo en recepción: cada trozo se escribe al llegar, sin armarlo en memoria"""
+
+    def __init__(self, directory, name, size, sender):
+        os.makedirs(directory, exist_ok=True)
+        self.name = safe_name(name)
+        self.size = size
+        self.sender = sender
+        self.path = self._free_path(directory, self.name)
+        # Se escribe con otro nombre hasta verificar el SHA-256
+        self.partial_path = self.path + '.parcial'
+        self.file = open(self.partial_path, 'wb')
+        self.digest = hashlib.sha256()
+        self.received = 0
+        self.next_seq = 0
+
+    @staticmethod
+    def _free_path(directory, name):
+        path = os.path.join(directory, name)
+        base, extension = os.path.splitext(path)
+        counter = 1
+        # Otra descarga con el mismo nombre puede estar en curso
+        while os.path.exists(path) or os.path.exists(path + '.parcial'):
+            path = f'{base} ({counter}){extension}'
+            counter += 1
+        return path
+
+    def write(self, seq, data):
+        if seq != self.next_seq or self.received + len(data) > self.size:
+            raise ValueError('trozo fuera de orden o de más')
+        self.file.write(data)
+        self.digest.update(data)
+        self.received += len(data)
+        self.next_seq += 1
+
+    def finish(self, sha256):
+        """Cierra el archivo. Devuelve True si está completo y el SHA-256 coincide"""
+        self.file.close()
+        if self.received != self.size or self.digest.hexdigest() != sha256:
+            os.remove(self.partial_path)
+            return False
+        os.replace(self.partial_path, self.path)
+        return True
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.partial_path)
+        except FileNotFoundError:
+            pass
+
+
+class RelayTransfer:
+    """Transferencia vista por el servidor: solo cuenta bytes, no guarda datos"""
+
+    __slots__ = ('transfer_id', 'sender', 'name', 'size', 'recipients', 'received', 'next_seq')
+
+    def __init__(self, transfer_id, sender, name, size, recipients):
+        self.transfer_id = transfer_id
+        self.sender = sender  # Session del participante que envía
+        self.name = name
+        self.size = size
+        self.recipients = recipients  # Sessions que reciben los trozos
+        self.received = 0
+        self.next_seq = 0
@@ -0,0 +1,74 @@
+import struct
+
+# Cada trama es: [Longitud: 4 bytes big-endian][Payload: Longitud bytes]
+HEADER = struct.Struct('!I')
+HEADER_SIZE = HEADER.size
+
+# Tamaño máximo aceptado para una trama (protege contra longitudes falsas)
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Tamaño de cada lectura del socket: una sola llamada vacía varias tramas
+RECV_SIZE = 65536
+
+
+class FrameError(ValueError):
+    """La secuencia de bytes recibida no es un flujo de tramas válido"""
+
+
+def encode_frame(payload):
+    """Antepone la longitud al payload"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f'Trama demasiado grande: {len(payload)} bytes')
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """Decodificador incremental de tramas.
+
+    Acumula los bytes recibidos y devuelve todas las tramas completas que
+    contengan, sin importar cómo TCP haya partido o unido los envíos.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Agrega bytes al buffer y devuelve la lista de payloads completos"""
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        offset = 0
+        available = len(buffer)
+
+        while available - offset >= HEADER_SIZE:
+            (length,) = HEADER.unpack_from(buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f'Trama demasiado grande: {length} bytes')
+            end = offset + HEADER_SIZE + length
+            if end > available:
+                break
+            frames.append(bytes(buffer[offset + HEADER_SIZE:end]))
+            offset = end
+
+        # Se descarta de una sola vez todo lo consumido
+        if offset:
+            del buffer[:offset]
+        return frames
+
+    def pending(self):
+        """Bytes recibidos que aún no forman una trama completa"""
+        return len(self.buffer)
+
+
+def recv_exact(sock, size):
+    """Lee exactamente size bytes de un socket bloqueante"""
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = sock.recv(remaining)
+        if not chunk:
+            raise ConnectionError('Conexion cerrada durante la lectura')
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
@@ -0,0 +1,70 @@
+"""Claves de grupo por sala para cifrar un broadcast una sola vez.
+
+Un sobre de grupo usa el mismo formato que seal(), precedido por una marca
+y la época de la clave:
+
+    [GROUP_MARKER: 4][Época: 4][Nonce: 8][HMAC: 32][Mensaje Cifrado]
+
+La marca ocupa el lugar de los bytes altos del nonce de sesión, que es un
+contador y nunca llega a esos valores. Cada cambio de miembros de una sala
+genera una clave nueva con una época nueva.
+"""
+import itertools
+import os
+import threading
+
+from cipher import seal, unseal
+
+GROUP_MARKER = b'\xff\xff\xff\xff'
+GROUP_HEADER_SIZE = len(GROUP_MARKER) + 4
+GROUP_KEY_SIZE = 32
+
+# Épocas que conserva un cliente: un broadcast cifrado justo antes de la
+# rotación puede llegar después de la clave nueva
+KEPT_EPOCHS = 2
+
+_epochs = itertools.count(1)
+
+
+class GroupKey:
+    """Clave de una sala durante una época"""
+
+    def __init__(self, room):
+        self.room = room
+        self.epoch = next(_epochs)
+        self.key = os.urandom(GROUP_KEY_SIZE)
+        self.nonce = 0
+        self.lock = threading.Lock()
+
+    def seal(self, message):
+        with self.lock:
+            self.nonce += 1
+            nonce = self.nonce
+        return GROUP_MARKER + self.epoch.to_bytes(4, 'big') + seal(message, self.key, nonce)
+
+    def announcement(self):
+        """Campos del control 'group_key' que recibe cada miembro por su sesión"""
+        return {'room': self.room, 'epoch': self.epoch, 'key': self.key.hex()}
+
+
+def is_group_envelope(envelope):
+    return envelope[:len(GROUP_MARKER)] == GROUP_MARKER
+
+
+def open_group_envelope(envelope, keys):
+    """Verifica y descifra un sobre de grupo con las claves {época: clave} conocidas"""
+    epoch = int.from_bytes(envelope[len(GROUP_MARKER):GROUP_HEADER_SIZE], 'big')
+    key = keys.get(epoch)
+    if key is None:
+        return None
+    opened = unseal(envelope[GROUP_HEADER_SIZE:], key)
+    if opened is None:
+        return None
+    return opened[1]
+
+
+def remember_key(keys, control):
+    """Guarda la clave de un control 'group_key' y olvida las épocas viejas"""
+    keys[control['epoch']] = bytes.fromhex(control['key'])
+    for epoch in sorted(keys)[:-KEPT_EPOCHS]:
+        del keys[epoch]
@@ -0,0 +1,144 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from cipher import MASTER_KEY, derive_key
+from metrics import REGISTRY, STAGE_SECONDS
+
+# Se envía en lugar del Server Nonce cuando el servidor no admite más handshakes
+BUSY_MARKER = b'SERVER_BUSY\x00\x00\x00\x00\x00'
+
+# El cliente lo envía en lugar del Client Nonce para reanudar con un ticket:
+# [RESUME_MARKER: 16][Ticket ID: 16][Client Nonce: 16]
+RESUME_MARKER = b'RESUME_TICKET\x00\x00\x00'
+
+# Se envía en lugar del Server Nonce si el ticket no existe o caducó
+RESUME_REJECTED = b'RESUME_REJECTED\x00'
+
+# Un gateway (web-server.py) lo envía antes del Client Nonce: su conexión
+# no es un participante sino que multiplexa a muchos usuarios web
+GATEWAY_MARKER = b'CHAT_GATEWAY\x00\x00\x00\x00'
+
+# Segundos que tiene un cliente para completar el handshake: el servidor
+# corta la conexión pasado ese tiempo y el cliente deja de esperar
+HANDSHAKE_TIMEOUT = 10
+
+# Espera aceptable de una derivación en la cola del pool. Sin un máximo
+# explícito, el pool admite los handshakes que sus workers terminan en ese
+# tiempo y rechaza el resto enseguida, antes de que el cliente se canse
+DEFAULT_MAX_WAIT = 5.0
+
+HANDSHAKES_REJECTED = REGISTRY.counter(
+    'chat_handshakes_rejected_total', 'Handshakes rechazados por cola llena'
+)
+
+
+class ServerBusy(Exception):
+    """La cola de handshakes está llena"""
+
+
+def _timed_derive(material):
+    # Se ejecuta en el worker: devuelve también cuándo empezó y cuánto tardó
+    # para medir la espera en cola y el coste de PBKDF2 por separado
+    started_at = time.time()
+    started = time.perf_counter()
+    key = derive_key(MASTER_KEY, material)
+    return started_at, time.perf_counter() - started, key
+
+
+def _derive_cost():
+    """Segundos de una derivación PBKDF2 en esta máquina"""
+    started = time.perf_counter()
+    derive_key(MASTER_KEY, os.urandom(48))
+    return time.perf_counter() - started
+
+
+class HandshakePool:
+    """Pool acotado para la derivación PBKDF2 de los handshakes.
+
+    Limita los handshakes en vuelo a max_pending; por encima de ese número
+    submit() lanza ServerBusy para que el servidor rechace la conexión en
+    lugar de saturar la CPU. Sin max_pending, el tope es workers × max_wait
+    entre lo que tarda una derivación, medido al crear el pool.
+    """
+
+    def __init__(self, workers=None, max_pending=None, kind='thread', max_wait=DEFAULT_MAX_WAIT):
+        self.workers = workers or os.cpu_count() or 1
+        self.fixed_pending = max_pending
+        self.max_wait = max_wait
+        self.derive_cost = _derive_cost() if max_pending is None else 0.0
+        self.kind = kind
+        if kind == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                               thread_name_prefix='handshake')
+
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def max_pending(self):
+        if self.fixed_pending is not None:
+            return self.fixed_pending
+        return max(self.workers, int(self.workers * self.max_wait / max(self.derive_cost, 1e-3)))
+
+    def submit(self, material):
+        """Encola la derivación de la clave de sesión. Devuelve un Future con la clave"""
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                HANDSHAKES_REJECTED.inc()
+                raise ServerBusy(f'{self.pending} handshakes en cola')
+            self.pending += 1
+
+        submitted_at = time.time()
+        try:
+            timed = self.executor.submit(_timed_derive, material)
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+            raise
+
+        result = Future()
+
+        def done(future):
+            with self.lock:
+                self.pending -= 1
+            try:
+                started_at, derivation, key = future.result()
+            except Exception as e:
+                result.set_exception(e)
+                return
+            wait = max(0.0, started_at - submitted_at)
+            STAGE_SECONDS.labels('handshake_wait').observe(wait)
+            STAGE_SECONDS.labels('derive_key').observe(derivation)
+            with self.lock:
+                self.completed += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            result.set_result(key)
+
+        timed.add_done_callback(done)
+        return result
+
+    def stats(self):
+        with self.lock:
+            average = self.wait_total / self.completed if self.completed else 0.0
+            return {
+                'workers': self.workers,
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'wait_avg_ms': average * 1000,
+                'wait_max_ms': self.wait_max * 1000,
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,272 @@
+"""Historial persistente de mensajes por sala.
+
+Cada sala tiene un log de solo anexado dividido en segmentos. Un segmento
+son dos archivos:
+
+    <base>.log  registros [Longitud: 4 bytes][Mensaje UTF-8]
+    <base>.idx  entradas fijas [Timestamp: 8 bytes (double)][Offset en .log: 4 bytes]
+
+<base> es el número de secuencia del primer mensaje del segmento. Las
+lecturas mapean los archivos con mmap y recorren solo las entradas
+pedidas, sin cargar segmentos completos en memoria.
+
+El directorio de una sala y su segmento activo se crean con el primer
+mensaje: consultar una sala vacía no crea nada. HistoryStore mantiene
+abiertas como mucho MAX_OPEN_ROOMS salas y cierra las menos usadas. Cada
+sala escribe bajo su propio lock: las salas no se esperan entre sí.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+RECORD_HEADER = struct.Struct('!I')
+INDEX_ENTRY = struct.Struct('!dI')
+
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+DEFAULT_RETENTION_SEGMENTS = 16
+
+# Salas con el segmento activo abierto (dos descriptores cada una)
+MAX_OPEN_ROOMS = 128
+
+
+class Segment:
+    def __init__(self, directory, base):
+        self.base = base
+        self.log_path = os.path.join(directory, f'{base:016d}.log')
+        self.index_path = os.path.join(directory, f'{base:016d}.idx')
+
+    def entries(self):
+        try:
+            return os.path.getsize(self.index_path) // INDEX_ENTRY.size
+        except FileNotFoundError:
+            return 0
+
+    def last_timestamp(self):
+        count = self.entries()
+        if not count:
+            return None
+        with open(self.index_path, 'rb') as index:
+            index.seek((count - 1) * INDEX_ENTRY.size)
+            return INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[0]
+
+    def read(self, start=0, since=None):
+        """Genera (timestamp, mensaje) desde la entrada start o desde el timestamp since"""
+        try:
+            index_file = open(self.index_path, 'rb')
+            log_file = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            # La retención borró el segmento mientras se leía el historial
+            return
+        with index_file, log_file:
+            # El .log se escribe antes que el .idx: toda entrada contada ya tiene sus datos
+            count = os.fstat(index_file.fileno()).st_size // INDEX_ENTRY.size
+            if count <= start:
+                return
+            index = mmap.mmap(index_file.fileno(), count * INDEX_ENTRY.size, access=mmap.ACCESS_READ)
+            log = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if since is not None:
+                    start = max(start, self._search(index, count, since))
+                for entry in range(start, count):
+                    timestamp, offset = INDEX_ENTRY.unpack_from(index, entry * INDEX_ENTRY.size)
+                    (length,) = RECORD_HEADER.unpack_from(log, offset)
+                    begin = offset + RECORD_HEADER.size
+                    yield timestamp, log[begin:begin + length].decode('utf-8')
+            finally:
+                index.close()
+                log.close()
+
+    @staticmethod
+    def _search(index, count, since):
+        # Primera entrada con timestamp >= since (el índice está ordenado)
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if INDEX_ENTRY.unpack_from(index, middle * INDEX_ENTRY.size)[0] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def remove(self):
+        for path in (self.log_path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class RoomLog:
+    """Log segmentado de una sala"""
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 retention_segments=DEFAULT_RETENTION_SEGMENTS, retention_seconds=0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention_segments = retention_segments
+        self.retention_seconds = retention_seconds
+        self.lock = threading.Lock()
+        self.log_file = self.index_file = None  # Segmento activo, abierto con el primer append
+        self.closed = False  # Cerrado por el LRU: los appends van a un RoomLog nuevo
+
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            names = []
+        bases = sorted(int(name[:-4]) for name in names if name.endswith('.idx'))
+        self.segments = [Segment(directory, base) for base in bases]
+
+    def _open_active(self):
+        # Llamar con self.lock
+        if not self.segments:
+            os.makedirs(self.directory, exist_ok=True)
+            self.segments.append(Segment(self.directory, 0))
+        active = self.segments[-1]
+        self.log_file = open(active.log_path, 'ab')
+        self.index_file = open(active.index_path, 'ab')
+        self.next_sequence = active.base + active.entries()
+
+    def append(self, message, timestamp=None):
+        """Anexa un mensaje. Devuelve False, sin escribir, si el log ya se cerró"""
+        record = message.encode('utf-8')
+        with self.lock:
+            if self.closed:
+                return False
+            if self.log_file is None:
+                self._open_active()
+            offset = self.log_file.tell()
+            if offset and offset + RECORD_HEADER.size + len(record) > self.segment_size:
+                self._roll()
+                offset = 0
+            self.log_file.write(RECORD_HEADER.pack(len(record)) + record)
+            self.log_file.flush()
+            self.index_file.write(INDEX_ENTRY.pack(timestamp or time.time(), offset))
+            self.index_file.flush()
+            self.next_sequence += 1
+        return True
+
+    def _roll(self):
+        # Llamar con self.lock: cierra el segmento activo y aplica la retención
+        self.log_file.close()
+        self.index_file.close()
+        self.segments.append(Segment(self.directory, self.next_sequence))
+        self._open_active()
+
+        expired = []
+        if self.retention_segments:
+            expired = self.segments[:-self.retention_segments]
+        if self.retention_seconds:
+            limit = time.time() - self.retention_seconds
+            for segment in self.segments[len(expired):-1]:
+                last = segment.last_timestamp()
+                if last is not None and last >= limit:
+                    break
+                expired.append(segment)
+        for segment in expired:
+            segment.remove()
+        self.segments = self.segments[len(expired):]
+
+    def last(self, count):
+        """Genera los últimos count mensajes en orden"""
+        if count <= 0:
+            return
+        with self.lock:
+            segments = list(self.segments)
+        # Se cuentan entradas hacia atrás sin leer los mensajes
+        start_segment, start_entry = 0, 0
+        remaining = count
+        for position in range(len(segments) - 1, -1, -1):
+            entries = segments[position].entries()
+            if entries >= remaining:
+                start_segment, start_entry = position, entries - remaining
+                break
+            remaining -= entries
+        for position in range(start_segment, len(segments)):
+            yield from segments[position].read(start_entry if position == start_segment else 0)
+
+    def since(self, timestamp, limit=None):
+        """Genera los mensajes con timestamp >= timestamp (como mucho limit)"""
+        with self.lock:
+            segments = list(self.segments)
+        sent = 0
+        for segment in segments:
+            last = segment.last_timestamp()
+            if last is None or last < timestamp:
+                continue
+            for item in segment.read(since=timestamp):
+                if limit is not None and sent >= limit:
+                    return
+                sent += 1
+                yield item
+
+    def close(self):
+        """Cierra el segmento activo. Espera al append en curso; los siguientes
+        devuelven False"""
+        with self.lock:
+            self.closed = True
+            if self.log_file is not None:
+                self.log_file.close()
+                self.index_file.close()
+                self.log_file = self.index_file = None
+
+
+class HistoryStore:
+    """Historial de todas las salas bajo un directorio"""
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 retention_segments=DEFAULT_RETENTION_SEGMENTS, retention_seconds=0,
+                 max_open_rooms=MAX_OPEN_ROOMS):
+        self.directory = directory
+        self.options = {
+            'segment_size': segment_size,
+            'retention_segments': retention_segments,
+            'retention_seconds': retention_seconds,
+        }
+        self.max_open_rooms = max_open_rooms
+        self.rooms = OrderedDict()  # nombre -> RoomLog, de la menos a la más usada
+        self.lock = threading.Lock()
+
+    def room(self, name, create=True):
+        """RoomLog de una sala. Sin create, None si la sala nunca tuvo mensajes"""
+        with self.lock:
+            return self._room(name, create)
+
+    def _room(self, name, create):
+        # Llamar con self.lock
+        log = self.rooms.get(name)
+        if log is not None:
+            self.rooms.move_to_end(name)
+            return log
+        # El nombre en hexadecimal es seguro como nombre de directorio
+        path = os.path.join(self.directory, name.encode('utf-8').hex())
+        if not create and not os.path.isdir(path):
+            return None
+        log = self.rooms[name] = RoomLog(path, **self.options)
+        while len(self.rooms) > self.max_open_rooms:
+            _, evicted = self.rooms.popitem(last=False)
+            evicted.close()
+        return log
+
+    def append(self, room, message, timestamp=None):
+        # El lock del store solo cubre la búsqueda; la escritura usa el de la
+        # sala. Si el LRU la cerró entre una y otra, se busca de nuevo: el
+        # RoomLog nuevo se crea después del cierre y nunca hay dos escritores
+        while not self.room(room).append(message, timestamp):
+            pass
+
+    def last(self, room, count):
+        log = self.room(room, create=False)
+        return log.last(count) if log else iter(())
+
+    def since(self, room, timestamp, limit=None):
+        log = self.room(room, create=False)
+        return log.since(timestamp, limit) if log else iter(())
+
+    def close(self):
+        with self.lock:
+            for log in self.rooms.values():
+                log.close()
+            self.rooms.clear()
@@ -0,0 +1,264 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+from metrics import REGISTRY, STAGE_SECONDS
+from protocol import decode_control, encode_control
+
+# Mensajes y bytes pendientes por cliente antes de considerarlo un consumidor
+# lento. Una trama puede medir hasta 1 MiB: sin el límite en bytes, un lector
+# atascado retendría cerca de 1 GiB antes de aplicarle la política
+OUTBOUND_MAXSIZE = 1024
+OUTBOUND_MAX_BYTES = 8 * 1024 * 1024
+
+# Qué hacer cuando la cola de un cliente llega al máximo
+DISCONNECT = 'disconnect'  # Cortar la conexión (el cliente puede reconectar)
+DROP_OLDEST = 'drop-oldest'  # Descartar el mensaje más antiguo pendiente
+DROP_NEWEST = 'drop-newest'  # Descartar el mensaje que llega
+SLOW_CONSUMER_POLICIES = (DISCONNECT, DROP_OLDEST, DROP_NEWEST)
+
+SLOW_CONSUMER_EVENTS = REGISTRY.counter(
+    'chat_slow_consumer_events_total', 'Mensajes a un consumidor lento por politica aplicada', ['policy']
+)
+ENCODE_ERRORS = REGISTRY.counter(
+    'chat_outbound_encode_errors_total', 'Mensajes descartados al cifrarlos en la cola de salida'
+)
+BYTES_SENT = REGISTRY.counter('chat_bytes_sent_total', 'Bytes escritos en los sockets de los clientes')
+SEND_STAGE = STAGE_SECONDS.labels('socket_send')
+
+
+class SealedFrame(bytes):
+    """Trama ya cifrada (por ejemplo, con la clave de grupo de una sala).
+
+    El escritor la envía tal cual; el mismo objeto se comparte entre todos
+    los destinatarios de un broadcast.
+    """
+
+
+class OutboundQueue:
+    """Cola de salida acotada de un cliente.
+
+    Los productores (broadcast, ACKs) solo encolan mensajes en claro; un
+    escritor dedicado los cifra con encode() y los envía en orden, así un
+    socket lento nunca bloquea a quien hace el broadcast.
+
+    maxsize (mensajes) y max_bytes son las marcas de nivel alto: al
+    alcanzar cualquiera se aplica policy. Un mensaje solo siempre entra en
+    una cola vacía. Los mensajes essential (controles como 'welcome' o
+    'group_key') nunca se descartan; con las políticas de descarte pueden
+    superar el máximo.
+    """
+
+    def __init__(self, encode, maxsize=OUTBOUND_MAXSIZE, on_failure=None, policy=DISCONNECT,
+                 max_bytes=OUTBOUND_MAX_BYTES):
+        self.encode = encode
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.on_failure = on_failure
+        self.policy = policy
+        self.items = deque()  # (mensaje, essential)
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.closed = False
+        self.lock = threading.Condition()
+
+    def put(self, item, essential=False):
+        """Encola sin bloquear. Devuelve False si el mensaje no quedó encolado"""
+        with self.lock:
+            if self.closed:
+                return False
+            if self._fits(len(item)):
+                self._append(item, essential)
+                return True
+            if self.policy != DISCONNECT:
+                return self._overflow(item, essential)
+        SLOW_CONSUMER_EVENTS.labels(DISCONNECT).inc()
+        self.fail('cola de salida llena')
+        return False
+
+    def _fits(self, size):
+        # Llamar con self.lock
+        if not self.items:
+            return True
+        return len(self.items) < self.maxsize and self.queued_bytes + size <= self.max_bytes
+
+    def _append(self, item, essential):
+        self.items.append((item, essential))
+        self.queued_bytes += len(item)
+        self._wakeup()
+
+    def _overflow(self, item, essential):
+        # Llamar con self.lock y sin lugar para item
+        room = False
+        if self.policy == DROP_OLDEST:
+            # Se descartan los más antiguos no esenciales hasta que entre
+            position = 0
+            while position < len(self.items) and not self._fits(len(item)):
+                pending, pending_essential = self.items[position]
+                if pending_essential:
+                    position += 1
+                    continue
+                del self.items[position]
+                self.queued_bytes -= len(pending)
+                self._dropped()
+            room = self._fits(len(item))
+        if not room and not essential:
+            self._dropped()
+            return False
+        self._append(item, essential)
+        return True
+
+    def _dropped(self):
+        self.dropped += 1
+        SLOW_CONSUMER_EVENTS.labels(self.policy).inc()
+
+    def encode_item(self, item):
+        if isinstance(item, SealedFrame):
+            return item
+        return self.encode(item)
+
+    def encode_batch(self, batch):
+        """Cifra lo pendiente. Un mensaje que no se puede codificar (por ejemplo,
+        más grande que una trama) se descarta sin detener al escritor"""
+        frames = []
+        for item in batch:
+            try:
+                frames.append(self.encode_item(item))
+            except Exception as e:
+                ENCODE_ERRORS.inc()
+                print(f'[-] Mensaje descartado en la cola de salida: {e}')
+        return b''.join(frames)
+
+    def take_all(self):
+        with self.lock:
+            batch = [item for item, _ in self.items]
+            self.items.clear()
+            self.queued_bytes = 0
+            return batch
+
+    def depth(self):
+        return len(self.items)
+
+    def half_full(self):
+        """True si la cola pasó la mitad de alguno de sus máximos"""
+        return len(self.items) >= self.maxsize // 2 or self.queued_bytes >= self.max_bytes // 2
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self._wakeup()
+
+    def fail(self, reason):
+        """Cierra la cola y avisa una sola vez al servidor"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._wakeup()
+        if self.on_failure:
+            self.on_failure(reason)
+
+    def _wakeup(self):
+        raise NotImplementedError
+
+
+class ThreadedOutbound(OutboundQueue):
+    """Cola de salida vaciada por un hilo escritor propio"""
+
+    def __init__(self, conn, encode, maxsize=OUTBOUND_MAXSIZE, on_failure=None, policy=DISCONNECT,
+                 max_bytes=OUTBOUND_MAX_BYTES):
+        super().__init__(encode, maxsize, on_failure, policy, max_bytes)
+        self.conn = conn
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _wakeup(self):
+        self.lock.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.items and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    return
+            # Todo lo pendiente sale en una sola llamada a sendall
+            data = self.encode_batch(self.take_all())
+            if not data:
+                continue
+            started = time.perf_counter()
+            try:
+                self.conn.sendall(data)
+            except OSError as e:
+                self.fail(e)
+                return
+            SEND_STAGE.observe(time.perf_counter() - started)
+            BYTES_SENT.inc(len(data))
+
+
+class AsyncOutbound(OutboundQueue):
+    """Cola de salida vaciada por una tarea del event loop.
+
+    put() debe llamarse desde el hilo del event loop.
+    """
+
+    def __init__(self, writer, encode, maxsize=OUTBOUND_MAXSIZE, on_failure=None, policy=DISCONNECT,
+                 max_bytes=OUTBOUND_MAX_BYTES):
+        super().__init__(encode, maxsize, on_failure, policy, max_bytes)
+        self.writer = writer
+        self.event = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def _wakeup(self):
+        self.event.set()
+
+    async def run(self):
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            if self.closed:
+                return
+            data = self.encode_batch(self.take_all())
+            if not data:
+                continue
+            try:
+                # Solo se mide write(): drain() incluye la espera por el cliente
+                started = time.perf_counter()
+                self.writer.write(data)
+                SEND_STAGE.observe(time.perf_counter() - started)
+                await self.writer.drain()
+            except (ConnectionError, OSError) as e:
+                self.fail(e)
+                return
+            BYTES_SENT.inc(len(data))
+
+
+class RelayOutbound:
+    """Salida de un usuario multiplexado sobre la conexión de un gateway.
+
+    Cada mensaje viaja por la cola del gateway dentro de un control 'relay'
+    que indica a qué usuario va dirigido.
+    """
+
+    def __init__(self, gateway_outbound, user):
+        self.gateway_outbound = gateway_outbound
+        self.user = user
+
+    def put(self, item, essential=False):
+        control = decode_control(item)
+        if control is not None:
+            relay = encode_control('relay', control=control, users=[self.user])
+        else:
+            relay = encode_control('relay', text=item.decode('utf-8'), users=[self.user])
+        return self.gateway_outbound.put(relay, essential)
+
+    def depth(self):
+        return 0
+
+    def half_full(self):
+        return self.gateway_outbound.half_full()
+
+    def close(self):
+        pass
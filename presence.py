@@ -0,0 +1,86 @@
+"""Presencia por sala: quién está en cada sala, con versión.
+
+Cada cambio de miembros incrementa la versión de la sala y genera un delta
+compacto ('presence') que reciben los miembros con la capacidad
+'presence'. La lista completa ('roster') y su versión en texto se cachean
+hasta el siguiente cambio, así /users no recorre la sala en cada consulta.
+
+    roster:   {"room": ..., "version": N, "users": [[id, nombre], ...],
+               "part": i, "parts": n}
+    presence: {"room": ..., "version": N, "joined": [[id, nombre]]} o {"left": [id]}
+
+Una sala grande no cabe en una trama: la lista viaja en varios controles
+'roster' de como mucho ROSTER_CHUNK_USERS miembros, numerados con part y
+parts. El cliente solo reemplaza su lista al recibir la última parte.
+
+Un cliente aplica un delta solo si su versión es la siguiente a la suya;
+si detecta un salto pide la lista completa con un control 'roster'.
+"""
+from protocol import encode_control
+
+FEATURE = 'presence'
+
+# Nombres que lista la respuesta en texto de /users
+TEXT_LIMIT = 100
+
+# Miembros por control 'roster'. Con nombres de hasta 64 caracteres, aun con
+# el peor escape de JSON, cada parte queda lejos de MAX_FRAME_SIZE
+ROSTER_CHUNK_USERS = 1000
+
+
+class RoomRoster:
+    """Miembros de una sala: id -> nombre, en orden de llegada"""
+
+    def __init__(self, room):
+        self.room = room
+        self.version = 0
+        self.members = {}
+        self._snapshot = None
+        self._text = None
+
+    def join(self, user_id, name):
+        """Agrega un miembro y devuelve el delta codificado"""
+        self.members[user_id] = name
+        return self._changed(joined=[[user_id, name]])
+
+    def leave(self, user_id):
+        """Quita un miembro y devuelve el delta codificado (None si no estaba)"""
+        if self.members.pop(user_id, None) is None:
+            return None
+        return self._changed(left=[user_id])
+
+    def _changed(self, **delta):
+        self.version += 1
+        self._snapshot = self._text = None
+        return encode_control('presence', room=self.room, version=self.version, **delta)
+
+    def snapshot(self):
+        """Controles 'roster' con la lista completa, cacheados por versión"""
+        if self._snapshot is None:
+            users = [[user_id, name] for user_id, name in self.members.items()]
+            chunks = [users[start:start + ROSTER_CHUNK_USERS]
+                      for start in range(0, len(users), ROSTER_CHUNK_USERS)] or [[]]
+            self._snapshot = tuple(
+                encode_control('roster', room=self.room, version=self.version, users=chunk,
+                               part=part, parts=len(chunks))
+                for part, chunk in enumerate(chunks)
+            )
+        return self._snapshot
+
+    def text(self):
+        """Respuesta de /users para los clientes sin la capacidad 'presence'"""
+        if self._text is None:
+            self._text = format_roster(self.room, self.members)
+        return self._text
+
+    def __len__(self):
+        return len(self.members)
+
+
+def format_roster(room, members, limit=TEXT_LIMIT):
+    """Texto de /users a partir de {id: nombre}"""
+    names = list(members.values())
+    listed = ', '.join(names[:limit])
+    if len(names) > limit:
+        listed += f' y {len(names) - limit} mas'
+    return f"Usuarios en la sala {room} ({len(names)}): {listed}"
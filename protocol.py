@@ -0,0 +1,31 @@
+import json
+
+# Los mensajes de control empiezan con un byte NUL, que nunca aparece en el
+# texto que escribe un usuario. Todo lo demás es texto de chat en UTF-8.
+CONTROL_PREFIX = b'\x00'
+
+# Texto máximo de un mensaje de chat (bytes UTF-8). El escape de JSON puede
+# multiplicar cada byte por 6 (\u0001): aun así un relay hacia un gateway,
+# con su prefijo y su lista de usuarios, cabe en una trama (MAX_FRAME_SIZE)
+MAX_TEXT_SIZE = 128 * 1024
+# Bytes de ids de usuario por relay; las salas web grandes usan varios relays
+RELAY_USERS_SIZE = 64 * 1024
+
+
+def encode_control(kind, **fields):
+    """Serializa un mensaje de control: NUL + JSON con el campo 'type'"""
+    fields['type'] = kind
+    return CONTROL_PREFIX + json.dumps(fields, separators=(',', ':')).encode('utf-8')
+
+
+def decode_control(message):
+    """Devuelve el dict de un mensaje de control, o None si es texto de chat"""
+    if message[:1] != CONTROL_PREFIX:
+        return None
+    try:
+        control = json.loads(message[1:].decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if not isinstance(control, dict) or 'type' not in control:
+        return None
+    return control
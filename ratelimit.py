@@ -0,0 +1,140 @@
+"""Límite de mensajes por sesión y turnos justos para sus broadcasts.
+
+Cada participante tiene un token bucket: rate mensajes por segundo con
+ráfagas de hasta burst. Un mensaje que llega sin token no se descarta
+enseguida: se difiere hasta que la sesión junte uno, siempre que la espera
+no pase de max_delay. Si pasa, se rechaza.
+
+Los mensajes admitidos no se reenvían en el hilo que los recibió: quedan en
+la cola de su emisor (Session.pending) y FairScheduler atiende a los
+emisores por turnos, un mensaje por turno. Un emisor con cientos de
+mensajes pendientes demora el siguiente mensaje de otro como mucho un turno.
+
+Sin límite de ritmo, dos topes impiden que un emisor llene las colas de
+todos: cada emisor tiene como mucho MAX_PENDING mensajes en espera (al
+llegar, el servidor deja de leer su socket) y, si tras reenviar uno alguna
+cola de salida de la sala pasó de la mitad, su siguiente mensaje espera
+CONGESTION_DELAY.
+"""
+import threading
+import time
+from collections import deque
+
+# Mensajes por segundo (0 = sin límite salvo que se pase --rate-limit),
+# ráfaga y espera máxima de un mensaje diferido (segundos)
+DEFAULT_RATE = 0.0
+DEFAULT_BURST = 40
+DEFAULT_MAX_DELAY = 2.0
+
+# Mensajes admitidos que un emisor puede tener esperando turno (igual a la
+# ventana del envío masivo del cliente) y pausa de un emisor cuyos mensajes
+# llenan las colas de su sala (segundos)
+MAX_PENDING = 256
+CONGESTION_DELAY = 0.05
+
+# Mensajes que el motor asyncio atiende seguidos antes de ceder el event loop
+DRAIN_BATCH = 64
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def reserve(self, now, max_delay):
+        """Toma un token. Devuelve los segundos a esperar por él (0 si había)
+        o None si la espera pasaría de max_delay, sin tomarlo.
+
+        Los tokens pueden quedar en negativo: son los ya prometidos a
+        mensajes diferidos, que se pagan con lo que se recarga después.
+        """
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        delay = max(0.0, (1 - tokens) / self.rate)
+        if delay > max_delay:
+            self.tokens = tokens
+            return None
+        self.tokens = tokens - 1
+        return delay
+
+
+class FairScheduler:
+    """Round robin entre los emisores con mensajes pendientes.
+
+    submit() encola en la cola del emisor y next() devuelve el siguiente
+    trabajo ya vencido, uno por emisor y por vuelta. run() es el bucle del
+    motor con hilos; el motor asyncio llama a next() desde el event loop.
+    """
+
+    def __init__(self):
+        self.ready = deque()  # Emisores con pendientes, cada uno una sola vez
+        self.lock = threading.Condition()
+
+    def submit(self, session, due, callback, *args):
+        """Encola callback(*args) para ejecutarse a partir de due (monotonic)"""
+        with self.lock:
+            if session.pending is None:
+                session.pending = deque()
+            session.pending.append((due, callback, args))
+            if len(session.pending) == 1:
+                self.ready.append(session)
+            self.lock.notify()
+
+    def defer(self, session, until):
+        """Posterga hasta until (monotonic) el próximo pendiente de session"""
+        with self.lock:
+            pending = session.pending
+            if pending and pending[0][0] < until:
+                _, callback, args = pending[0]
+                pending[0] = (until, callback, args)
+
+    def discard(self, session):
+        """Olvida lo pendiente de una sesión que se cierra; next() la saltea"""
+        with self.lock:
+            if session.pending:
+                session.pending.clear()
+
+    def next(self, now):
+        """Devuelve ((due, callback, args), None) con el siguiente trabajo vencido,
+        o (None, espera) con los segundos hasta el próximo (None si no hay)"""
+        with self.lock:
+            return self._next(now)
+
+    def _next(self, now):
+        # Llamar con self.lock
+        wait = None
+        for _ in range(len(self.ready)):
+            session = self.ready.popleft()
+            pending = session.pending
+            if not pending:
+                continue
+            if pending[0][0] > now:
+                # Diferido por su token bucket: pierde el turno, no la posición
+                self.ready.append(session)
+                remaining = pending[0][0] - now
+                wait = remaining if wait is None else min(wait, remaining)
+                continue
+            job = pending.popleft()
+            if pending:
+                self.ready.append(session)
+            return job, None
+        return None, wait
+
+    def run(self, execute):
+        """Bucle del hilo planificador: execute(job) fuera del lock"""
+        while True:
+            with self.lock:
+                job, wait = self._next(time.monotonic())
+                if job is None:
+                    self.lock.wait(wait)
+                    continue
+            execute(job)
+
+    def __len__(self):
+        """Emisores con mensajes pendientes"""
+        with self.lock:
+            return sum(1 for session in self.ready if session.pending)
@@ -1,179 +1,1143 @@
+import argparse
 import socket
 import threading
 import hashlib
-import hmac
 import os
 import time
 from datetime import datetime
 
+from cipher import (ENVELOPE_HEADER_SIZE, NONCE_SIZE, seal, verify_hmac,
+                    vernam_encrypt_decrypt)
+from compression import COMPRESSION_THRESHOLD, FEATURE as LZ4_FEATURE
+from compression import available as lz4_available, compress_payload, decompress_payload
+from filetransfer import FEATURE as FILE_FEATURE, MAX_FILE_SIZE, SENDER_CONTROLS as FILE_CONTROLS
+from filetransfer import MAX_TRANSFERS, TRANSFER_ID_SIZE, RelayTransfer, is_chunk, parse_chunk, safe_name
+from framing import FrameDecoder, RECV_SIZE, encode_frame, recv_exact
+from groupkeys import GroupKey
+from handshake import (BUSY_MARKER, DEFAULT_MAX_WAIT, GATEWAY_MARKER, HANDSHAKE_TIMEOUT, RESUME_MARKER,
+                       RESUME_REJECTED, HandshakePool, ServerBusy)
+from history import DEFAULT_RETENTION_SEGMENTS, DEFAULT_SEGMENT_SIZE, HistoryStore
+from metrics import REGISTRY, STAGE_SECONDS, start_http_server
+from outbound import (DISCONNECT, OUTBOUND_MAX_BYTES, OUTBOUND_MAXSIZE, SLOW_CONSUMER_POLICIES,
+                      RelayOutbound, SealedFrame, ThreadedOutbound)
+from presence import FEATURE as PRESENCE_FEATURE, RoomRoster
+from protocol import MAX_TEXT_SIZE, RELAY_USERS_SIZE, decode_control, encode_control
+from ratelimit import (CONGESTION_DELAY, DEFAULT_BURST, DEFAULT_MAX_DELAY, DEFAULT_RATE, MAX_PENDING,
+                       FairScheduler, TokenBucket)
+from sessions import Session
+from timerwheel import TimerWheel
+from tickets import (DEFAULT_TICKET_CACHE_SIZE, DEFAULT_TICKET_LIFETIME, TICKET_ID_SIZE,
+                     TicketCache, resumed_session_key)
+
+MESSAGES_RECEIVED = REGISTRY.counter('chat_messages_received_total', 'Sobres recibidos de los clientes')
+MESSAGES_REJECTED = REGISTRY.counter(
+    'chat_messages_rejected_total', 'Sobres descartados por motivo', ['reason']
+)
+BROADCASTS = REGISTRY.counter('chat_broadcasts_total', 'Mensajes difundidos a la sala')
+FANOUT_RECIPIENTS = REGISTRY.counter(
+    'chat_fanout_recipients_total', 'Copias encoladas por los broadcasts'
+)
+HANDSHAKES = REGISTRY.counter('chat_handshakes_total', 'Sesiones establecidas', ['mode'])
+GROUP_SEALS = REGISTRY.counter('chat_group_seals_total', 'Broadcasts cifrados con la clave de sala')
+GROUP_DELIVERIES = REGISTRY.counter(
+    'chat_group_deliveries_total', 'Copias servidas desde un sobre de grupo compartido'
+)
+COMPRESSED = REGISTRY.counter(
+    'chat_compressed_payloads_total', 'Mensajes comprimidos con lz4', ['direction']
+)
+GROUP_ROTATIONS = REGISTRY.counter('chat_group_key_rotations_total', 'Rotaciones de claves de sala')
+PRESENCE_SENT = REGISTRY.counter(
+    'chat_presence_sent_total', 'Controles de presencia encolados', ['kind']
+)
+FILE_TRANSFERS = REGISTRY.counter(
+    'chat_file_transfers_total', 'Transferencias de archivos terminadas', ['result']
+)
+FILE_BYTES = REGISTRY.counter(
+    'chat_file_bytes_relayed_total', 'Bytes de archivos encolados a los destinatarios'
+)
+RATE_LIMITED = REGISTRY.counter(
+    'chat_rate_limited_total', 'Mensajes de chat diferidos o rechazados por ritmo o congestion', ['action']
+)
+REAPED = REGISTRY.counter(
+    'chat_reaped_connections_total', 'Conexiones cerradas por timeout', ['reason']
+)
+
+# Sala en la que entra todo cliente al conectarse
+DEFAULT_ROOM = 'general'
+MAX_ROOM_NAME = 32
+# Nombre de un usuario web: forma parte del prefijo de cada mensaje suyo
+MAX_USER_NAME = 64
+
+# Mensajes del historial que recibe quien entra a una sala y tope de /history
+DEFAULT_HISTORY_REPLAY = 20
+HISTORY_MAX_REPLAY = 1000
+# El historial viaja en mensajes de varias líneas de como mucho este tamaño
+HISTORY_CHUNK_SIZE = 32 * 1024
+# Entrada más larga que se reenvía: un mensaje admitido más su prefijo
+MAX_HISTORY_ENTRY = MAX_TEXT_SIZE + 1024
+
+# Segundos entre heartbeats y sin actividad (0 = desactivado); el del handshake
+# (HANDSHAKE_TIMEOUT) lo comparten los clientes. El heartbeat y el corte por
+# inactividad solo aplican a sesiones con la capacidad 'heartbeat'
+HEARTBEAT_INTERVAL = 30
+IDLE_TIMEOUT = 90
+
+HANDSHAKE_STAGE = STAGE_SECONDS.labels('handshake')
+HMAC_STAGE = STAGE_SECONDS.labels('hmac_verify')
+XOR_STAGE = STAGE_SECONDS.labels('xor_decrypt')
+SEAL_STAGE = STAGE_SECONDS.labels('seal')
+FANOUT_STAGE = STAGE_SECONDS.labels('broadcast_fanout')
+SCHEDULER_STAGE = STAGE_SECONDS.labels('scheduler_wait')
+
+
+def relay_batches(users, limit=RELAY_USERS_SIZE):
+    """Parte la lista de usuarios de un relay para que cada relay quepa en una trama"""
+    batch = []
+    size = 0
+    for user in users:
+        if batch and size + len(user) > limit:
+            yield batch
+            batch, size = [], 0
+        batch.append(user)
+        size += len(user) + 3  # Comillas y coma en el JSON
+    if batch:
+        yield batch
+
 
 class SecureChatServer:
-    def __init__(self, host='0.0.0.0', port=65432):
+    def __init__(self, host='0.0.0.0', port=65432, outbound_maxsize=OUTBOUND_MAXSIZE,
+                 outbound_max_bytes=OUTBOUND_MAX_BYTES,
+                 handshake_pool=None, backlog=128, tickets=None, reuse_port=False, bus=None,
+                 group_keys=False, history=None, history_replay=DEFAULT_HISTORY_REPLAY,
+                 compress_threshold=COMPRESSION_THRESHOLD, slow_consumer_policy=DISCONNECT,
+                 handshake_timeout=HANDSHAKE_TIMEOUT, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 idle_timeout=IDLE_TIMEOUT, max_file_size=MAX_FILE_SIZE, max_transfers=MAX_TRANSFERS,
+                 rate_limit=DEFAULT_RATE, rate_burst=DEFAULT_BURST, rate_max_delay=DEFAULT_MAX_DELAY,
+                 max_pending=MAX_PENDING):
         self.host = host
         self.port = port
-        self.sessions = {}
-        self.clients = []  # Lista de clientes conectados
-        self.lock = threading.Lock()
+        self.backlog = backlog
+        self.reuse_port = reuse_port  # Varios workers comparten el puerto
+        self.bus = bus  # BusClient del modo multiproceso
+        self.remote_counts = {}  # Participantes por sala en los demás workers
+        self.outbound_maxsize = outbound_maxsize
+        self.outbound_max_bytes = outbound_max_bytes
+        self.slow_consumer_policy = slow_consumer_policy  # Qué hacer con una cola llena
+        self.handshake_pool = handshake_pool or HandshakePool()
+        self.tickets = tickets or TicketCache()
+        self.sessions = {}  # session_id -> Session de cada conexión
+        self.clients = {}  # Participantes por session_id (incluye usuarios de gateways)
+        self.gateways = {}  # Conexiones de gateways (web) que multiplexan usuarios
+        self.room_index = {}  # sala -> {session_id: cliente}
+        self.rooms = {}  # sala -> copia inmutable de sus miembros para el broadcast
+        self.rosters = {}  # sala -> RoomRoster con versión y lista cacheada
+        self.group_keys_enabled = group_keys
+        self.group_keys = {}  # sala -> GroupKey vigente
+        self.history = history  # HistoryStore o None si no se guarda historial
+        self.history_replay = history_replay
+        # lz4 solo se negocia si está instalado y hay un umbral
+        self.compress_threshold = compress_threshold if lz4_available() else 0
+        self.handshake_timeout = handshake_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.timers = TimerWheel()
+        self.max_file_size = max_file_size  # 0 = sin transferencias de archivos
+        self.max_transfers = max_transfers  # Simultáneas por emisor
+        self.rate_limit = rate_limit  # Mensajes por segundo por participante (0 = sin límite)
+        self.rate_burst = rate_burst
+        self.rate_max_delay = rate_max_delay
+        self.max_pending = max_pending  # Mensajes de un emisor esperando turno
+        self.scheduler = FairScheduler()
+        self.lock = threading.Lock()  # Solo protege los cambios de membresía
+        self.register_metrics()
 
-    def vernam_encrypt_decrypt(self, data, key):
-        return bytes([data[i] ^ key[i % len(key)] for i in range(len(data))])
+    def register_metrics(self):
+        """Gauges calculados al exportar: no cuestan nada en el camino crítico"""
+        REGISTRY.gauge('chat_connected_clients', 'Participantes conectados',
+                       function=lambda: len(self.clients))
+        REGISTRY.gauge('chat_connected_gateways', 'Gateways conectados',
+                       function=lambda: len(self.gateways))
+        REGISTRY.gauge('chat_rooms', 'Salas con al menos un miembro',
+                       function=lambda: len(self.rooms))
+        REGISTRY.gauge('chat_sessions', 'Entradas en la tabla de sesiones',
+                       function=lambda: len(self.sessions))
+        REGISTRY.gauge('chat_resume_tickets', 'Tickets de reanudacion en memoria',
+                       function=lambda: len(self.tickets))
+        REGISTRY.gauge('chat_handshakes_pending', 'Derivaciones PBKDF2 en vuelo',
+                       function=lambda: self.handshake_pool.stats()['pending'])
+        REGISTRY.gauge('chat_timers', 'Temporizadores pendientes en la rueda',
+                       function=lambda: len(self.timers))
+        REGISTRY.gauge('chat_scheduler_senders', 'Participantes con mensajes esperando turno',
+                       function=lambda: len(self.scheduler))
+        REGISTRY.gauge('chat_outbound_queue_depth', 'Mensajes en las colas de salida',
+                       function=lambda: sum(self.outbound_depths()))
+        REGISTRY.gauge('chat_outbound_queue_depth_max', 'Cola de salida mas larga',
+                       function=lambda: max(self.outbound_depths(), default=0))
+        REGISTRY.gauge('chat_outbound_queue_bytes', 'Bytes en las colas de salida',
+                       function=lambda: sum(queue.queued_bytes for queue in self.outbound_queues()))
 
-    def derive_key(self, password, salt):
-        return hashlib.pbkdf2_hmac('sha256', password, salt, 100000, 32)
+    def outbound_queues(self):
+        """Colas propias: los usuarios de un gateway comparten la de su conexión"""
+        clients = list(self.clients.values()) + list(self.gateways.values())
+        return [client.outbound for client in clients if not client.gateway]
 
-    def verify_hmac(self, message, received_hmac, key):
-        expected_hmac = hmac.new(key, message, hashlib.sha256).digest()
-        return hmac.compare_digest(expected_hmac, received_hmac)
+    def outbound_depths(self):
+        return [queue.depth() for queue in self.outbound_queues()]
 
-    def broadcast_message(self, message, sender_session_id=None):
-        """Reenvía un mensaje a todos los clientes excepto al remitente"""
+    def broadcast_message(self, message, sender_session_id=None, room=None):
+        """Reenvía un mensaje a los miembros de la sala excepto al remitente.
+
+        Sin room se usa la sala del remitente (o la sala por defecto).
+        Devuelve True si alguna cola local quedó por encima de la mitad.
+        """
+        if room is None:
+            room = self.get_client_room(sender_session_id)
         timestamp = datetime.now().strftime("%H:%M:%S")
 
+        # El mensaje se formatea una sola vez; cada escritor lo cifra con su clave
+        if sender_session_id:
+            sender_addr = self.get_client_address(sender_session_id)
+            formatted_msg = f"[{timestamp}] {sender_addr}: {message}"
+        else:
+            formatted_msg = f"[{timestamp}] SISTEMA: {message}"
+
+        congested = self.deliver(formatted_msg, room, sender_session_id)
+        # Solo se guardan los mensajes de participantes, no los avisos del sistema
+        record = sender_session_id is not None
+        if record and self.history:
+            self.history.append(room, formatted_msg)
+        if self.bus:
+            self.bus.publish('broadcast', text=formatted_msg, room=room, record=record)
+        return congested
+
+    def deliver(self, formatted_msg, room, sender_session_id=None):
+        """Encola un mensaje ya formateado para los miembros locales de una sala.
+
+        Devuelve True si alguna de las colas usadas pasó de la mitad.
+        """
+        payload = formatted_msg.encode('utf-8')
+        started = time.perf_counter()
+
+        # Solo se recorre la sala: el coste depende de sus miembros, no del total
+        group = self.group_keys.get(room)
+        shared = {}  # Una trama de grupo con lz4 y otra sin él, según el miembro
+        relays = {}
+        queued = 0
+        congested = False
+        for client in self.rooms.get(room, ()):
+            if client.session_id == sender_session_id:
+                continue
+            if client.gateway:
+                # Los usuarios de un gateway reciben una sola copia por conexión
+                relays.setdefault(client.gateway, []).append(client.member)
+            elif group is not None and client.group_epoch == group.epoch:
+                # Cifrado y HMAC una sola vez; todos comparten la misma trama
+                compressed = client.compression
+                frame = shared.get(compressed)
+                if frame is None:
+                    body = self.compress_for(client, payload)
+                    frame = shared[compressed] = SealedFrame(encode_frame(group.seal(body)))
+                    GROUP_SEALS.inc()
+                client.outbound.put(frame)
+                GROUP_DELIVERIES.inc()
+                queued += 1
+            else:
+                client.outbound.put(payload)
+                queued += 1
+            congested = congested or client.outbound.half_full()
+
+        for gateway_id, users in relays.items():
+            gateway = self.gateways.get(gateway_id)
+            if gateway:
+                for batch in relay_batches(users):
+                    gateway.outbound.put(encode_control('relay', text=formatted_msg, users=batch))
+                queued += 1
+                congested = congested or gateway.outbound.half_full()
+
+        FANOUT_STAGE.observe(time.perf_counter() - started)
+        BROADCASTS.inc()
+        FANOUT_RECIPIENTS.inc(queued)
+        return congested
+
+    def send_to(self, session_id, message):
+        """Encola un mensaje para un solo cliente"""
+        client = self.clients.get(session_id)
+        if client:
+            client.outbound.put(message.encode('utf-8'))
+
+    def participant_count(self, room=DEFAULT_ROOM):
+        """Miembros de una sala, incluidos los de otros workers"""
+        remote = sum(counts.get(room, 0) for counts in self.remote_counts.values())
+        return len(self.rooms.get(room, ())) + remote
+
+    def membership_changed(self, *rooms):
+        """Tras cambiar los miembros de esas salas: rota sus claves y avisa a los workers"""
+        for room in rooms:
+            self.rotate_group_key(room)
+        if self.bus:
+            self.bus.publish('members', rooms={room: len(self.rooms.get(room, ())) for room in rooms})
+
+    def rotate_group_key(self, room):
+        """Genera una clave nueva para la sala y la envía a sus miembros por su sesión"""
+        if not self.group_keys_enabled:
+            return
         with self.lock:
-            for client in self.clients[:]:  # Copia de la lista para evitar problemas durante iteración
-                try:
-                    if client['session_id'] != sender_session_id:
-                        # Formatear mensaje para el receptor
-                        if sender_session_id:
-                            sender_addr = self.get_client_address(sender_session_id)
-                            formatted_msg = f"[{timestamp}] {sender_addr}: {message}"
-                        else:
-                            formatted_msg = f"[{timestamp}] SISTEMA: {message}"
-
-                        # Cifrar y enviar
-                        encrypted_msg = self.encrypt_message(
-                            formatted_msg.encode('utf-8'),
-                            client['session_key'],
-                            client['nonce_counter'] + 1
-                        )
-                        client['connection'].send(encrypted_msg)
-                        client['nonce_counter'] += 1
-                except Exception as e:
-                    print(f"[-] Error enviando a {client['address']}: {e}")
-                    self.remove_client(client['session_id'])
+            members = self.rooms.get(room, ())
+            if not members:
+                self.group_keys.pop(room, None)
+                return
+            group = self.group_keys[room] = GroupKey(room)
+        GROUP_ROTATIONS.inc()
+        for client in members:
+            # Si otra rotación ya la reemplazó, esa se encarga de repartir la suya
+            if client.group_keys and self.group_keys.get(room) is group:
+                self.send_group_key(client, group)
+
+    def send_group_key(self, client, group):
+        # La clave va por la cola del cliente, antes que cualquier trama cifrada con ella
+        client.outbound.put(encode_control('group_key', **group.announcement()), essential=True)
+        client.group_epoch = group.epoch
+
+    def handle_bus(self, control):
+        """Mensaje de otro worker recibido por el bus"""
+        if control['type'] == 'broadcast':
+            self.deliver(control['text'], control['room'])
+            if control.get('record') and self.history:
+                self.history.append(control['room'], control['text'])
+        elif control['type'] == 'members':
+            counts = self.remote_counts.setdefault(control['worker'], {})
+            for room, count in control['rooms'].items():
+                if count:
+                    counts[room] = count
+                else:
+                    counts.pop(room, None)
+        elif control['type'] == 'worker_down':
+            self.remote_counts.pop(control['worker'], None)
+
+    def call_in_server(self, callback, *args):
+        """Ejecuta callback en el contexto del motor (aquí, en el hilo que llama)"""
+        callback(*args)
 
     def get_client_address(self, session_id):
         """Obtiene la dirección de un cliente por su session_id"""
-        for client in self.clients:
-            if client['session_id'] == session_id:
-                return client['address']
-        return "Desconocido"
+        client = self.clients.get(session_id)
+        return client.address if client else "Desconocido"
+
+    def get_client_room(self, session_id):
+        client = self.clients.get(session_id)
+        return client.room if client else DEFAULT_ROOM
+
+    def _enter_room(self, client, room):
+        # Llamar con self.lock: actualiza el índice y la copia de la sala
+        members = self.room_index.setdefault(room, {})
+        members[client.session_id] = client
+        self.rooms[room] = tuple(members.values())
+        client.room = room
+
+        roster = self.rosters.get(room)
+        if roster is None:
+            roster = self.rosters[room] = RoomRoster(room)
+        self._push_presence(room, roster.join(client.session_id.hex(), str(client.address)), client)
+        if client.presence:
+            self._send_roster(client)
+
+    def _exit_room(self, client):
+        # Llamar con self.lock
+        room = client.room
+        members = self.room_index.get(room, {})
+        members.pop(client.session_id, None)
+        if members:
+            self.rooms[room] = tuple(members.values())
+            delta = self.rosters[room].leave(client.session_id.hex())
+            self._push_presence(room, delta, client)
+        else:
+            self.room_index.pop(room, None)
+            self.rooms.pop(room, None)
+            self.rosters.pop(room, None)
+        return room
+
+    def _push_presence(self, room, delta, changed):
+        # Llamar con self.lock: así cada miembro recibe los deltas en orden de versión
+        if delta is None:
+            return
+        sent = 0
+        for member in self.rooms.get(room, ()):
+            if member.presence and member is not changed:
+                member.outbound.put(delta)
+                sent += 1
+        PRESENCE_SENT.labels('delta').inc(sent)
+
+    def _send_roster(self, client):
+        # Llamar con self.lock; la lista se serializa una vez por versión
+        roster = self.rosters.get(client.room)
+        if roster is not None:
+            for part in roster.snapshot():
+                client.outbound.put(part)
+            PRESENCE_SENT.labels('roster').inc()
+
+    def roster_text(self, session_id):
+        """Respuesta de /users desde la lista cacheada de la sala"""
+        with self.lock:
+            client = self.clients.get(session_id)
+            roster = self.rosters.get(client.room) if client else None
+            return roster.text() if roster else "Sin usuarios"
+
+    def join_room(self, session_id, room):
+        """Mueve a un cliente a otra sala (una sala a la vez)"""
+        room = room.strip()
+        if not room or len(room) > MAX_ROOM_NAME:
+            self.send_to(session_id, f"ERROR: Nombre de sala invalido (1-{MAX_ROOM_NAME} caracteres)")
+            return
+        with self.lock:
+            client = self.clients.get(session_id)
+            if client is None:
+                return
+            previous = client.room
+            if previous == room:
+                joined = False
+            else:
+                self._exit_room(client)
+                self._enter_room(client, room)
+                joined = True
+        if not joined:
+            self.send_to(session_id, f"Ya estas en la sala {room}")
+            return
 
-    def add_client(self, conn, addr, session_id, session_key):
+        self.membership_changed(previous, room)
+        name = client.address
+        self.broadcast_message(f"Usuario {name} salio de la sala", room=previous)
+        self.broadcast_message(f"Usuario {name} se unio a la sala", room=room)
+        self.send_to(session_id, f"Ahora estas en la sala {room} ({self.participant_count(room)} personas)")
+        self.replay_on_join(session_id, room)
+
+    def replay_on_join(self, session_id, room):
+        if self.history and self.history_replay:
+            self.send_history(session_id, room, self.history.last(room, self.history_replay))
+
+    def send_history(self, session_id, room, entries):
+        """Envía entradas del historial agrupadas en mensajes de varias líneas.
+
+        entries se consume de forma perezosa desde los segmentos mapeados.
+        Devuelve cuántos mensajes se enviaron.
+        """
+        chunk = [f"--- Historial de la sala {room} ---"]
+        size = 0
+        total = 0
+        for _, text in entries:
+            length = len(text.encode('utf-8')) + 1
+            if length > MAX_HISTORY_ENTRY:
+                continue  # Anterior al límite de tamaño: no cabría en una trama
+            # Cada mensaje tiene como mucho HISTORY_CHUNK_SIZE o una sola entrada
+            if chunk and size + length > HISTORY_CHUNK_SIZE:
+                self.send_to(session_id, '\n'.join(chunk))
+                chunk, size = [], 0
+            chunk.append(text)
+            size += length
+            total += 1
+        if total:
+            chunk.append(f"--- Fin del historial ({total} mensajes) ---")
+            self.send_to(session_id, '\n'.join(chunk))
+        return total
+
+    def handle_history(self, session_id, argument):
+        """/history [N | HH:MM | AAAA-MM-DDTHH:MM]: últimos N mensajes o desde una hora"""
+        if not self.history:
+            self.send_to(session_id, "ERROR: El historial no esta habilitado en este servidor")
+            return
+        room = self.get_client_room(session_id)
+        argument = argument.strip()
+        try:
+            if not argument or argument.isdigit():
+                count = min(int(argument or self.history_replay or DEFAULT_HISTORY_REPLAY),
+                            HISTORY_MAX_REPLAY)
+                entries = self.history.last(room, count)
+            else:
+                entries = self.history.since(room, parse_since(argument), limit=HISTORY_MAX_REPLAY)
+        except ValueError:
+            self.send_to(session_id, "ERROR: Uso: /history [N | HH:MM | AAAA-MM-DDTHH:MM]")
+            return
+        if not self.send_history(session_id, room, entries):
+            self.send_to(session_id, "Sin mensajes en el historial")
+
+    def add_client(self, conn, addr, session_id, session_key, gateway=False):
         """Agrega un cliente a la lista de conectados"""
+        # El registro de la sesión pasa a describir también la conexión
+        client = self.sessions[session_id]
+        client.connection = conn
+        client.address = addr
+        client.outbound = self.create_outbound(conn, client)
+
+        if gateway:
+            # Un gateway no es un participante: sus usuarios se agregan con attach
+            client.members = {}
+            with self.lock:
+                self.gateways[session_id] = client
+            print(f'[+] Gateway {addr} conectado')
+            return
+
         with self.lock:
-            self.clients.append({
-                'connection': conn,
-                'address': addr,
-                'session_id': session_id,
-                'session_key': session_key,
-                'nonce_counter': 0
-            })
+            self.clients[session_id] = client
+            self._enter_room(client, DEFAULT_ROOM)
         print(f'[+] Cliente {addr} agregado. Total: {len(self.clients)}')
-        self.broadcast_message(f"Usuario {addr} se ha unido al chat")
+        self.membership_changed(DEFAULT_ROOM)
+        self.broadcast_message(f"Usuario {addr} se ha unido al chat", room=DEFAULT_ROOM)
+        self.replay_on_join(session_id, DEFAULT_ROOM)
 
     def remove_client(self, session_id):
         """Elimina un cliente de la lista"""
         with self.lock:
-            for client in self.clients[:]:
-                if client['session_id'] == session_id:
-                    self.clients.remove(client)
-                    addr = client['address']
-                    print(f'[+] Cliente {addr} removido. Total: {len(self.clients)}')
-                    self.broadcast_message(f"Usuario {addr} ha dejado el chat")
-                    break
+            removed = self.clients.pop(session_id, None)
+            if removed:
+                room = self._exit_room(removed)
+            gateway = self.gateways.pop(session_id, None)
 
-    def handle_client(self, conn, addr):
-        session_id = None
-        try:
-            print(f'[+] Nueva conexion de {addr}')
+        if gateway:
+            gateway.outbound.close()
+            print(f"[+] Gateway {gateway.address} desconectado")
+            for user in list(gateway.members):
+                self.detach_member(gateway, user)
 
-            # Establecimiento seguro de sesión
-            salt = os.urandom(16)
-            conn.send(salt)
+        if removed:
+            self.scheduler.discard(removed)
+            removed.outbound.close()
+            addr = removed.address
+            print(f'[+] Cliente {addr} removido. Total: {len(self.clients)}')
+            self.membership_changed(room)
+            self.broadcast_message(f"Usuario {addr} ha dejado el chat", room=room)
 
-            client_nonce = conn.recv(16)
-            if len(client_nonce) != 16:
-                raise ValueError("Nonce invalido")
+    def attach_member(self, gateway, user, name):
+        """Agrega un usuario multiplexado por un gateway como participante"""
+        if user in gateway.members:
+            return
+        member_id = hashlib.sha256(gateway.session_id + user.encode('utf-8')).digest()[:8]
+        # Sin clave propia: lo que se cifra y comprime es la conexión del gateway
+        client = Session(member_id)
+        client.connection = gateway.connection
+        client.address = name
+        client.gateway = gateway.session_id
+        client.member = user
+        client.outbound = RelayOutbound(gateway.outbound, user)
+        with self.lock:
+            gateway.members[user] = member_id
+            self.clients[member_id] = client
+            self._enter_room(client, DEFAULT_ROOM)
+        print(f'[+] Usuario {name} agregado via gateway. Total: {len(self.clients)}')
+        self.membership_changed(DEFAULT_ROOM)
+        self.broadcast_message(f"Usuario {name} se ha unido al chat", room=DEFAULT_ROOM)
+        self.replay_on_join(member_id, DEFAULT_ROOM)
 
-            server_nonce = os.urandom(16)
-            conn.send(server_nonce)
+    def detach_member(self, gateway, user):
+        with self.lock:
+            member_id = gateway.members.pop(user, None)
+        if member_id:
+            self.remove_client(member_id)
 
-            master_key = b'Luciernagas_GlobalFinance_2024'
-            session_key = self.derive_key(master_key, salt + client_nonce + server_nonce)
+    def create_outbound(self, conn, client):
+        return ThreadedOutbound(
+            conn,
+            lambda message: self.seal_for(client, message),
+            maxsize=self.outbound_maxsize,
+            on_failure=lambda reason: self.drop_connection(client, reason),
+            policy=self.slow_consumer_policy,
+            max_bytes=self.outbound_max_bytes
+        )
 
-            session_id = hashlib.sha256(client_nonce + server_nonce).digest()[:8]
-            self.sessions[session_id] = {
-                'session_key': session_key,
-                'last_nonce': 0,
-                'start_time': time.time()
-            }
+    def seal_for(self, client, message):
+        """Cifra un mensaje para un cliente. Solo lo llama su escritor"""
+        client.nonce_counter += 1
+        started = time.perf_counter()
+        message = self.compress_for(client, message)
+        frame = self.encrypt_message(message, client.session_key, client.nonce_counter)
+        SEAL_STAGE.observe(time.perf_counter() - started)
+        return frame
 
-            conn.send(session_id)
+    def compress_for(self, client, message):
+        if not client.compression:
+            return message
+        compressed = compress_payload(message, self.compress_threshold)
+        if compressed is not message:
+            COMPRESSED.labels('out').inc()
+        return compressed
 
-            # Agregar cliente a la lista
-            self.add_client(conn, addr, session_id, session_key)
+    def drop_connection(self, client, reason):
+        """Corta la conexión; el lector del cliente se encarga de limpiar la sesión"""
+        print(f"[-] Error enviando a {client.address}: {reason}")
+        self.shutdown_connection(client.connection)
 
-            # Comunicación segura
+    def shutdown_connection(self, conn):
+        """Despierta al lector de la conexión con EOF; él limpia la sesión"""
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def start_key_derivation(self, salt, client_nonce, server_nonce):
+        """Envía PBKDF2 al pool de handshakes. Lanza ServerBusy si la cola está llena"""
+        try:
+            return self.handshake_pool.submit(salt + client_nonce + server_nonce)
+        except ServerBusy as e:
+            print(f'[-] Servidor ocupado, conexion rechazada: {e}')
+            raise
+
+    def resume_key(self, ticket_id, salt, client_nonce, server_nonce):
+        """Canjea un ticket de reanudación. Devuelve la nueva clave o None si no es válido"""
+        secret = self.tickets.redeem(ticket_id)
+        if secret is None:
+            print('[-] Ticket de reanudacion invalido o caducado')
+            return None
+        return resumed_session_key(secret, salt, client_nonce, server_nonce)
+
+    def register_session(self, client_nonce, server_nonce, session_key, resumed=False):
+        session_id = hashlib.sha256(client_nonce + server_nonce).digest()[:8]
+        self.sessions[session_id] = Session(session_id, session_key, resumed)
+        return session_id, session_key
+
+    def close_session(self, session_id):
+        self.remove_client(session_id)
+        session = self.sessions.pop(session_id, None)
+        if session:
+            self.timers.cancel(session.timer)
+            for transfer in list((session.transfers or {}).values()):
+                self.end_transfer(session, transfer, 'el emisor se desconecto', notify_sender=False)
+
+    def start_timers(self):
+        """Avanza la rueda de temporizadores desde un hilo propio"""
+        def run():
             while True:
-                encrypted_data = conn.recv(1024)
-                if not encrypted_data:
-                    break
+                time.sleep(self.timers.tick)
+                self.timers.advance()
+
+        timer_thread = threading.Thread(target=run)
+        timer_thread.daemon = True
+        timer_thread.start()
+
+    def start_scheduler(self):
+        """Atiende por turnos los mensajes admitidos desde un hilo propio"""
+        scheduler_thread = threading.Thread(target=self.scheduler.run, args=(self.run_scheduled,))
+        scheduler_thread.daemon = True
+        scheduler_thread.start()
+
+    def wake_scheduler(self, delay):
+        # submit() ya despierta al hilo planificador
+        pass
+
+    def run_scheduled(self, job):
+        due, callback, args = job
+        SCHEDULER_STAGE.observe(max(0.0, time.monotonic() - due))
+        try:
+            callback(*args)
+        except Exception as e:
+            print(f'[-] Error atendiendo mensaje: {e}')
+
+    def admit_chat(self, session, message_text, nonce=None):
+        """Aplica el token bucket del participante y pasa su mensaje al planificador.
 
-                if len(encrypted_data) < 48:
-                    continue
+        El reenvío ya no ocurre en el hilo (o la corrutina) que lo recibió:
+        así un emisor insistente no acapara el fan-out. Sus mensajes en espera
+        no pasan de max_pending.
+        """
+        if len(message_text.encode('utf-8')) > MAX_TEXT_SIZE:
+            # Se rechaza antes de encolar: reenviado o en un relay no cabría en una trama
+            MESSAGES_REJECTED.labels('size').inc()
+            self.reject_chat(session, nonce, 'size', f"ERROR: Mensaje demasiado largo (maximo {MAX_TEXT_SIZE} bytes)")
+            return
+        if session.pending and len(session.pending) >= self.max_pending:
+            MESSAGES_REJECTED.labels('busy').inc()
+            self.reject_chat(session, nonce, 'busy', "ERROR: Demasiados mensajes en espera, espera un momento")
+            return
+        now = time.monotonic()
+        delay = 0.0
+        if self.rate_limit:
+            if session.bucket is None:
+                session.bucket = TokenBucket(self.rate_limit, self.rate_burst)
+            delay = session.bucket.reserve(now, self.rate_max_delay)
+            if delay is None:
+                RATE_LIMITED.labels('rejected').inc()
+                self.reject_chat(session, nonce, 'rate', "ERROR: Demasiados mensajes, espera un momento")
+                return
+            if delay:
+                RATE_LIMITED.labels('deferred').inc()
+        self.scheduler.submit(session, now + delay, self.handle_chat, session.session_id, message_text, nonce)
+        self.wake_scheduler(delay)
 
-                message_nonce = encrypted_data[:8]
-                received_hmac = encrypted_data[8:40]
-                encrypted_message = encrypted_data[40:]
+    def sender_backlogged(self, session_id):
+        """True si el participante llenó su espera en el planificador.
 
-                nonce_value = int.from_bytes(message_nonce, 'big')
-                if nonce_value <= self.sessions[session_id]['last_nonce']:
-                    continue
+        Su lector deja de leer hasta que se libere lugar. Los usuarios de un
+        gateway comparten lector: a ellos admit_chat les rechaza el mensaje.
+        """
+        session = self.sessions.get(session_id)
+        return bool(session and session.pending and len(session.pending) >= self.max_pending)
 
-                self.sessions[session_id]['last_nonce'] = nonce_value
+    def reject_chat(self, session, nonce, reason, error):
+        if nonce is not None and 'acks' in session.features:
+            # El emisor masivo libera el lugar en su ventana y lo cuenta como rechazado
+            session.outbound.put(encode_control('ack', nonce=nonce, rejected=reason))
+        else:
+            self.send_to(session.session_id, error)
 
-                if not self.verify_hmac(encrypted_message, received_hmac, session_key):
-                    continue
+    def handshake_deadline(self, conn, addr):
+        """Programa el corte de una conexión que no completa el handshake a tiempo"""
+        if not self.handshake_timeout:
+            return None
+        return self.timers.schedule(self.handshake_timeout, self.handshake_expired, conn, addr)
 
-                decrypted_message = self.vernam_encrypt_decrypt(encrypted_message, session_key)
+    def handshake_expired(self, conn, addr):
+        print(f'[-] {addr} no completo el handshake a tiempo')
+        REAPED.labels('handshake').inc()
+        self.shutdown_connection(conn)
 
-                try:
-                    message_text = decrypted_message.decode('utf-8')
+    def check_idle(self, session):
+        """Temporizador de una sesión con heartbeat: 'ping' tras el intervalo sin
+        recibir nada y corte tras idle_timeout. Se reprograma en lugar de
+        moverse con cada mensaje: recibir solo actualiza last_seen.
+        """
+        if self.sessions.get(session.session_id) is not session:
+            return
+        idle = time.monotonic() - session.last_seen
+        if self.idle_timeout and idle >= self.idle_timeout:
+            print(f'[-] {session.address} sin actividad durante {idle:.0f} s, conexion cerrada')
+            REAPED.labels('idle').inc()
+            self.shutdown_connection(session.connection)
+            return
+        if idle < self.heartbeat_interval:
+            delay = self.heartbeat_interval - idle
+        else:
+            if not session.pinged:
+                session.pinged = True
+                session.outbound.put(encode_control('ping'), essential=True)
+            delay = self.idle_timeout - idle if self.idle_timeout else self.heartbeat_interval
+        session.timer = self.timers.schedule(delay, self.check_idle, session)
 
-                    # **REENVIAR mensaje a todos los clientes (excepto al remitente)**
-                    self.broadcast_message(message_text, sender_session_id=session_id)
+    def process_message(self, session_id, session_key, encrypted_data):
+        """Valida, descifra y reenvía un mensaje recibido de un cliente"""
+        MESSAGES_RECEIVED.inc()
+        if len(encrypted_data) < ENVELOPE_HEADER_SIZE:
+            MESSAGES_REJECTED.labels('short').inc()
+            return
 
-                    # Confirmación al remitente
-                    ack_msg = f"Tu mensaje fue enviado a {len(self.clients) - 1} personas"
-                    encrypted_ack = self.encrypt_message(ack_msg.encode('utf-8'), session_key, nonce_value + 1)
-                    conn.send(encrypted_ack)
+        # Mismo formato que cipher.unseal, separado para medir cada etapa.
+        # Vistas en lugar de cortes: un trozo de archivo no se copia antes del XOR
+        envelope = memoryview(encrypted_data)
+        nonce_value = int.from_bytes(envelope[:NONCE_SIZE], 'big')
+        received_hmac = envelope[NONCE_SIZE:ENVELOPE_HEADER_SIZE]
+        encrypted = envelope[ENVELOPE_HEADER_SIZE:]
 
-                except UnicodeDecodeError:
-                    error_msg = "ERROR: Mensaje corrupto"
-                    encrypted_error = self.encrypt_message(error_msg.encode('utf-8'), session_key, nonce_value + 1)
-                    conn.send(encrypted_error)
+        started = time.perf_counter()
+        valid = verify_hmac(encrypted, received_hmac, session_key)
+        verified = time.perf_counter()
+        HMAC_STAGE.observe(verified - started)
+        if not valid:
+            MESSAGES_REJECTED.labels('hmac').inc()
+            return
+
+        if nonce_value <= self.sessions[session_id].last_nonce:
+            MESSAGES_REJECTED.labels('replay').inc()
+            return
+
+        session = self.sessions[session_id]
+        session.last_nonce = nonce_value
+        session.last_seen = time.monotonic()
+        session.pinged = False
+        decrypted_message = vernam_encrypt_decrypt(encrypted, session_key)
+        XOR_STAGE.observe(time.perf_counter() - verified)
+
+        if LZ4_FEATURE in session.features:
+            try:
+                plain = decompress_payload(decrypted_message)
+            except ValueError:
+                MESSAGES_REJECTED.labels('decompress').inc()
+                self.send_to(session_id, "ERROR: Mensaje corrupto")
+                return
+            if plain is not decrypted_message:
+                COMPRESSED.labels('in').inc()
+            decrypted_message = plain
+
+        if is_chunk(decrypted_message):
+            self.handle_chunk(session, decrypted_message)
+            return
+        control = decode_control(decrypted_message)
+        if control is not None:
+            self.handle_control(session_id, control)
+            return
+        if session_id in self.gateways:
+            # Un gateway solo habla en nombre de sus usuarios ('say')
+            return
+
+        try:
+            message_text = decrypted_message.decode('utf-8')
+            self.admit_chat(session, message_text, nonce_value)
+
+        except UnicodeDecodeError:
+            MESSAGES_REJECTED.labels('decode').inc()
+            self.send_to(session_id, "ERROR: Mensaje corrupto")
+
+    def handle_chat(self, session_id, message_text, nonce=None):
+        """Texto de un participante: comando de sala o mensaje para su sala.
+
+        nonce es el del sobre recibido: con la capacidad 'acks' la
+        confirmación es un control 'ack' con ese nonce en lugar de texto.
+        """
+        if session_id not in self.clients:
+            return  # Se desconectó mientras su mensaje esperaba turno
+        command, _, argument = message_text.partition(' ')
+        if command == '/join':
+            self.join_room(session_id, argument)
+            return
+        if command == '/leave':
+            self.join_room(session_id, DEFAULT_ROOM)
+            return
+        if command == '/history':
+            self.handle_history(session_id, argument)
+            return
+        if command == '/users':
+            self.send_to(session_id, self.roster_text(session_id))
+            return
+
+        # **REENVIAR mensaje a los miembros de su sala (excepto al remitente)**
+        room = self.get_client_room(session_id)
+        congested = self.broadcast_message(message_text, sender_session_id=session_id, room=room)
+
+        # Confirmación al remitente
+        recipients = self.participant_count(room) - 1
+        session = self.sessions.get(session_id)
+        client = self.clients.get(session_id)
+        if congested and client:
+            # Las colas de la sala se llenan más rápido de lo que se vacían
+            RATE_LIMITED.labels('congested').inc()
+            self.scheduler.defer(client, time.monotonic() + CONGESTION_DELAY)
+        if nonce is not None and session and 'acks' in session.features:
+            if client:
+                # Como el texto, no es esencial: la política de consumidor lento lo aplica
+                client.outbound.put(encode_control('ack', nonce=nonce, recipients=recipients))
+        else:
+            self.send_to(session_id, f"Tu mensaje fue enviado a {recipients} personas")
+
+    def handle_control(self, session_id, control):
+        """Atiende un mensaje de control enviado por el cliente"""
+        session = self.sessions[session_id]
+        gateway = self.gateways.get(session_id)
+        if gateway and 'user' in control:
+            self.handle_gateway_control(gateway, control)
+            return
+
+        if control['type'] == 'hello':
+            # Negociación de capacidades; los clientes antiguos nunca envían hello
+            features = set(control.get('features', []))
+            welcome = {'features': []}
+            if 'resume' in features:
+                session.features.add('resume')
+                welcome['features'].append('resume')
+                ticket_id, lifetime = self.tickets.issue(session.session_key)
+                welcome['ticket'] = ticket_id.hex()
+                welcome['lifetime'] = lifetime
+            if 'acks' in features:
+                session.features.add('acks')
+                welcome['features'].append('acks')
+            client = self.clients.get(session_id)
+            presence = PRESENCE_FEATURE in features and client
+            if presence:
+                session.features.add(PRESENCE_FEATURE)
+                welcome['features'].append(PRESENCE_FEATURE)
+            if FILE_FEATURE in features and self.max_file_size:
+                session.features.add(FILE_FEATURE)
+                welcome['features'].append(FILE_FEATURE)
+                welcome['max_file_size'] = self.max_file_size
+            heartbeat = 'heartbeat' in features and self.heartbeat_interval
+            if heartbeat:
+                session.features.add('heartbeat')
+                welcome['features'].append('heartbeat')
+                welcome['heartbeat'] = self.heartbeat_interval
+            group_keys = 'group_keys' in features and self.group_keys_enabled and client
+            if group_keys:
+                session.features.add('group_keys')
+                welcome['features'].append('group_keys')
+            compression = LZ4_FEATURE in features and self.compress_threshold
+            if compression:
+                # Desde aquí el servidor acepta mensajes comprimidos de esta sesión
+                session.features.add(LZ4_FEATURE)
+                welcome['features'].append(LZ4_FEATURE)
+            self.send_control(session_id, 'welcome', **welcome)
+            if presence:
+                with self.lock:
+                    client.presence = True
+                    self._send_roster(client)
+            if heartbeat and session.timer is None:
+                session.timer = self.timers.schedule(self.heartbeat_interval, self.check_idle, session)
+            if compression:
+                (client or self.gateways[session_id]).compression = True
+            if group_keys:
+                client.group_keys = True
+                group = self.group_keys.get(client.room)
+                if group is not None:
+                    self.send_group_key(client, group)
+        elif control['type'] in FILE_CONTROLS:
+            client = self.clients.get(session_id)
+            if client:
+                self.handle_file_control(session, client, control)
+        elif control['type'] == 'roster':
+            # El cliente detectó un salto de versión: se le reenvía la lista completa
+            with self.lock:
+                client = self.clients.get(session_id)
+                if client and client.presence:
+                    self._send_roster(client)
+
+    def handle_gateway_control(self, gateway, control):
+        """Mensajes de un gateway en nombre de uno de sus usuarios"""
+        user = str(control['user'])
+        if control['type'] == 'attach':
+            self.attach_member(gateway, user, str(control.get('name') or user[:8])[:MAX_USER_NAME])
+        elif control['type'] == 'detach':
+            self.detach_member(gateway, user)
+        elif control['type'] == 'say':
+            # Cada usuario web tiene su propio límite y su turno, como un cliente directo
+            client = self.clients.get(gateway.members.get(user))
+            if client is None:
+                return
+            self.admit_chat(client, str(control.get('text', '')))
+        elif control['type'] in FILE_CONTROLS:
+            # Subidas desde la web: los trozos llegan por la conexión del gateway
+            client = self.clients.get(gateway.members.get(user))
+            if client:
+                self.handle_file_control(gateway, client, control)
+
+    def handle_file_control(self, origin, sender, control):
+        """Controles de quien comparte un archivo. origin es la conexión por la
+        que llegan sus trozos (la del cliente o la de su gateway)"""
+        try:
+            transfer_id = bytes.fromhex(str(control.get('id', '')))
+        except ValueError:
+            return
+        if len(transfer_id) != TRANSFER_ID_SIZE:
+            return
+        if control['type'] == 'file_offer':
+            self.offer_file(origin, sender, transfer_id, control)
+            return
+
+        transfer = (origin.transfers or {}).get(transfer_id)
+        if transfer is None or transfer.sender is not sender:
+            return
+        if control['type'] == 'file_abort':
+            self.end_transfer(origin, transfer, 'cancelado por el emisor', notify_sender=False)
+        elif transfer.received != transfer.size:
+            self.end_transfer(origin, transfer, 'archivo incompleto')
+        else:
+            self.finish_transfer(origin, transfer, str(control.get('sha256', '')))
+
+    def offer_file(self, origin, sender, transfer_id, control):
+        """Abre una transferencia hacia los miembros de la sala que aceptan archivos.
+
+        Cada emisor tiene como mucho max_transfers en curso y entre todas no
+        pasan de max_file_size bytes: así nadie llena los discos de la sala
+        con muchas transferencias en paralelo.
+        """
+        size = control.get('size')
+        name = safe_name(control.get('name', ''))
+        active = [transfer for transfer in (origin.transfers or {}).values() if transfer.sender is sender]
+        reason = None
+        if FILE_FEATURE not in origin.features:
+            reason = 'transferencias no negociadas'
+        elif not isinstance(size, int) or not 0 <= size <= self.max_file_size:
+            reason = f'tamaño invalido (maximo {self.max_file_size} bytes)'
+        elif origin.transfers and transfer_id in origin.transfers:
+            reason = 'id de transferencia repetido'
+        elif len(active) >= self.max_transfers:
+            reason = f'demasiadas transferencias en curso (maximo {self.max_transfers})'
+        elif sum(transfer.size for transfer in active) + size > self.max_file_size:
+            reason = f'demasiados bytes en curso (maximo {self.max_file_size} entre todas)'
+        recipients = tuple(member for member in self.rooms.get(sender.room, ())
+                           if member is not sender and FILE_FEATURE in member.features)
+        if reason is None and not recipients:
+            reason = 'nadie en la sala puede recibir archivos'
+        if reason:
+            self.send_file_control(origin, 'file_abort', transfer_id, reason=reason)
+            return
+
+        if origin.transfers is None:
+            origin.transfers = {}
+        origin.transfers[transfer_id] = RelayTransfer(transfer_id, sender, name, size, recipients)
+        offer = encode_control('file_offer', id=transfer_id.hex(), name=name, size=size,
+                               sender=str(sender.address))
+        for recipient in recipients:
+            recipient.outbound.put(offer, essential=True)
+        self.broadcast_message(f"Usuario {sender.address} comparte el archivo {name} ({size} bytes)",
+                               room=sender.room)
+
+    def handle_chunk(self, origin, message):
+        """Reenvía un trozo de archivo sin armar el archivo en memoria.
+
+        El mismo mensaje descifrado se encola para todos los destinatarios y
+        cada escritor lo cifra con su clave. Un destinatario cuya cola pasa
+        de la mitad del máximo (o que descarta el trozo) deja de recibir esta
+        transferencia con un 'file_abort', así un archivo nunca llena las
+        colas que también llevan el chat ni deja descargas a medias.
+        """
+        try:
+            transfer_id, seq, data = parse_chunk(message)
+        except ValueError:
+            MESSAGES_REJECTED.labels('file').inc()
+            return
+        transfer = (origin.transfers or {}).get(transfer_id)
+        if transfer is None:
+            MESSAGES_REJECTED.labels('file').inc()
+            return
+        if seq != transfer.next_seq or transfer.received + len(data) > transfer.size:
+            self.end_transfer(origin, transfer, 'trozo fuera de orden o de mas')
+            return
+        transfer.next_seq += 1
+        transfer.received += len(data)
+
+        kept = []
+        for recipient in transfer.recipients:
+            if not recipient.outbound.half_full() and recipient.outbound.put(message):
+                kept.append(recipient)
+            else:
+                self.send_file_control(recipient, 'file_abort', transfer_id, reason='receptor lento')
+        if len(kept) < len(transfer.recipients):
+            transfer.recipients = tuple(kept)
+            if not kept:
+                self.end_transfer(origin, transfer, 'sin destinatarios')
+                return
+        FILE_BYTES.inc(len(data) * len(kept))
+        # La confirmación abre la ventana del emisor
+        self.send_file_control(origin, 'file_ack', transfer_id, seq=seq)
+
+    def finish_transfer(self, origin, transfer, sha256):
+        del origin.transfers[transfer.transfer_id]
+        end = encode_control('file_end', id=transfer.transfer_id.hex(), sha256=sha256)
+        for recipient in transfer.recipients:
+            recipient.outbound.put(end, essential=True)
+        self.send_file_control(origin, 'file_done', transfer.transfer_id,
+                               recipients=len(transfer.recipients))
+        FILE_TRANSFERS.labels('completed').inc()
+
+    def end_transfer(self, origin, transfer, reason, notify_sender=True):
+        """Cancela una transferencia y avisa a sus destinatarios"""
+        origin.transfers.pop(transfer.transfer_id, None)
+        for recipient in transfer.recipients:
+            self.send_file_control(recipient, 'file_abort', transfer.transfer_id, reason=reason)
+        if notify_sender:
+            self.send_file_control(origin, 'file_abort', transfer.transfer_id, reason=reason)
+        FILE_TRANSFERS.labels('aborted').inc()
+
+    def send_file_control(self, session, kind, transfer_id, **fields):
+        # Esenciales: sin ellos el emisor se queda sin ventana o el receptor con un archivo a medias
+        session.outbound.put(encode_control(kind, id=transfer_id.hex(), **fields), essential=True)
+
+    def send_control(self, session_id, kind, **fields):
+        client = self.clients.get(session_id) or self.gateways.get(session_id)
+        if client:
+            client.outbound.put(encode_control(kind, **fields), essential=True)
+
+    def handshake(self, conn):
+        """Establecimiento seguro de sesión, común a los dos motores.
+
+        Es un generador que no lee del socket: cede los bytes que necesita
+        (un int) o el Future de la derivación PBKDF2, y recibe con send() los
+        bytes leídos o la clave. Cada motor lo conduce con sus propias
+        lecturas (run_handshake). Devuelve (session_id, session_key, gateway)
+        o None si la conexión se rechazó.
+        """
+        # Las tramas pequeñas del handshake no deben esperar a Nagle
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        started = time.perf_counter()
+        salt = os.urandom(16)
+        conn.sendall(salt)
+
+        client_nonce = yield 16
+        gateway = client_nonce == GATEWAY_MARKER
+        if gateway:
+            client_nonce = yield 16
+
+        server_nonce = os.urandom(16)
+        if client_nonce == RESUME_MARKER:
+            # Reanudación con ticket: sin PBKDF2
+            ticket_id = yield TICKET_ID_SIZE
+            client_nonce = yield 16
+            session_key = self.resume_key(ticket_id, salt, client_nonce, server_nonce)
+            if session_key is None:
+                conn.sendall(RESUME_REJECTED)
+                return None
+            conn.sendall(server_nonce)
+            resumed = True
+        else:
+            try:
+                derivation = self.start_key_derivation(salt, client_nonce, server_nonce)
+            except ServerBusy:
+                conn.sendall(BUSY_MARKER)
+                return None
+            conn.sendall(server_nonce)
+            session_key = yield derivation
+            resumed = False
+
+        session_id, session_key = self.register_session(
+            client_nonce, server_nonce, session_key, resumed
+        )
+        conn.sendall(session_id)
+        HANDSHAKE_STAGE.observe(time.perf_counter() - started)
+        HANDSHAKES.labels('resume' if resumed else 'full').inc()
+        return session_id, session_key, gateway
+
+    def run_handshake(self, conn):
+        """Conduce handshake() con lecturas bloqueantes desde el hilo del cliente"""
+        steps = self.handshake(conn)
+        reply = None
+        try:
+            while True:
+                step = steps.send(reply)
+                reply = recv_exact(conn, step) if isinstance(step, int) else step.result()
+        except StopIteration as done:
+            return done.value
+
+    def handle_client(self, conn, addr):
+        session_id = None
+        deadline = self.handshake_deadline(conn, addr)
+        try:
+            print(f'[+] Nueva conexion de {addr}')
+            established = self.run_handshake(conn)
+            if established is None:
+                return
+            session_id, session_key, gateway = established
+            self.timers.cancel(deadline)
+
+            # Agregar cliente a la lista
+            self.add_client(conn, addr, session_id, session_key, gateway)
+
+            # Comunicación segura: cada lectura puede traer varias tramas
+            decoder = FrameDecoder()
+            while True:
+                data = conn.recv(RECV_SIZE)
+                if not data:
+                    break
+
+                for encrypted_data in decoder.feed(data):
+                    while self.sender_backlogged(session_id):
+                        # Sin leer más, TCP frena al emisor hasta que se atiendan sus mensajes
+                        time.sleep(CONGESTION_DELAY)
+                    self.process_message(session_id, session_key, encrypted_data)
 
         except Exception as e:
             print(f'[-] Error con {addr}: {e}')
         finally:
+            self.timers.cancel(deadline)
             if session_id:
-                self.remove_client(session_id)
-                if session_id in self.sessions:
-                    del self.sessions[session_id]
+                self.close_session(session_id)
             conn.close()
 
     def encrypt_message(self, message, key, nonce):
-        encrypted = self.vernam_encrypt_decrypt(message, key)
-        message_hmac = hmac.new(key, encrypted, hashlib.sha256).digest()
-        nonce_bytes = nonce.to_bytes(8, 'big')
-        return nonce_bytes + message_hmac + encrypted
+        return encode_frame(seal(message, key, nonce))
 
     def start_server(self):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if self.bus:
+                self.bus.start(self)
+            self.start_timers()
+            self.start_scheduler()
             s.bind((self.host, self.port))
-            s.listen(5)
+            s.listen(self.backlog)
             print(f'[+] Servidor de chat grupal escuchando en {self.host}:{self.port}')
             print(f'[+] Los mensajes se reenvían entre clientes')
 
@@ -188,8 +1152,172 @@ class SecureChatServer:
                 print(f'[+] Desconectando {len(self.clients)} clientes...')
             finally:
                 s.close()
+                self.handshake_pool.shutdown()
+                if self.history:
+                    self.history.close()
+
+    def start_stats_logger(self, interval):
+        """Imprime periódicamente el estado de la cola de handshakes"""
+        def log_stats():
+            while True:
+                time.sleep(interval)
+                stats = self.handshake_pool.stats()
+                print(f"[stats] handshakes en cola: {stats['pending']}/{stats['max_pending']} "
+                      f"completados: {stats['completed']} rechazados: {stats['rejected']} "
+                      f"espera media: {stats['wait_avg_ms']:.1f} ms max: {stats['wait_max_ms']:.1f} ms")
+
+        stats_thread = threading.Thread(target=log_stats)
+        stats_thread.daemon = True
+        stats_thread.start()
+
+
+def parse_since(text):
+    """Timestamp de 'HH:MM[:SS]' (hoy) o de una fecha ISO. Lanza ValueError si no es válido"""
+    if 'T' not in text and '-' not in text:
+        moment = datetime.combine(datetime.now().date(), datetime.strptime(
+            text, '%H:%M:%S' if text.count(':') == 2 else '%H:%M').time())
+    else:
+        moment = datetime.fromisoformat(text)
+    return moment.timestamp()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Servidor de chat seguro')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=65432)
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='threads: un hilo por cliente; asyncio: un solo event loop')
+    parser.add_argument('--outbound-queue', type=int, default=OUTBOUND_MAXSIZE,
+                        help='mensajes pendientes por cliente antes de aplicar --slow-consumer')
+    parser.add_argument('--outbound-bytes', type=int, default=OUTBOUND_MAX_BYTES,
+                        help='bytes pendientes por cliente antes de aplicar --slow-consumer')
+    parser.add_argument('--slow-consumer', choices=SLOW_CONSUMER_POLICIES, default=DISCONNECT,
+                        help='con la cola de un cliente llena: desconectarlo, descartar su mensaje '
+                             'más antiguo o descartar el nuevo')
+    parser.add_argument('--backlog', type=int, default=None,
+                        help='conexiones pendientes de accept (threads: 128, asyncio: 1024)')
+    parser.add_argument('--handshake-pool', choices=['thread', 'process'], default='thread',
+                        help='tipo de pool para la derivación PBKDF2')
+    parser.add_argument('--handshake-workers', type=int, default=None,
+                        help='workers del pool de handshakes (por defecto, uno por CPU)')
+    parser.add_argument('--handshake-queue', type=int, default=None,
+                        help='handshakes en vuelo antes de responder "servidor ocupado" '
+                             '(por defecto, los que el pool completa en --handshake-max-wait)')
+    parser.add_argument('--handshake-max-wait', type=float, default=DEFAULT_MAX_WAIT,
+                        help='segundos que un handshake puede esperar en la cola del pool')
+    parser.add_argument('--ticket-lifetime', type=int, default=DEFAULT_TICKET_LIFETIME,
+                        help='segundos de validez de un ticket de reanudación')
+    parser.add_argument('--ticket-cache', type=int, default=DEFAULT_TICKET_CACHE_SIZE,
+                        help='máximo de tickets de reanudación en memoria')
+    parser.add_argument('--stats-interval', type=float, default=0,
+                        help='segundos entre líneas de estadísticas (0 = desactivado)')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='puerto HTTP para /metrics en formato Prometheus (0 = desactivado); '
+                             'con --workers, cada worker usa el puerto + su índice')
+    parser.add_argument('--group-keys', action='store_true',
+                        help='clave por sala: cada broadcast se cifra una vez para los clientes que la soporten')
+    parser.add_argument('--history-dir', default=None,
+                        help='directorio del historial persistente por sala (por defecto, sin historial)')
+    parser.add_argument('--history-segment-size', type=int, default=DEFAULT_SEGMENT_SIZE,
+                        help='bytes por segmento del historial')
+    parser.add_argument('--history-retention', type=int, default=DEFAULT_RETENTION_SEGMENTS,
+                        help='segmentos que se conservan por sala (0 = sin límite)')
+    parser.add_argument('--history-max-age', type=int, default=0,
+                        help='segundos que se conservan los segmentos cerrados (0 = sin límite)')
+    parser.add_argument('--history-replay', type=int, default=DEFAULT_HISTORY_REPLAY,
+                        help='mensajes del historial que se envían al entrar a una sala')
+    parser.add_argument('--compress-threshold', type=int, default=COMPRESSION_THRESHOLD,
+                        help='bytes a partir de los cuales se comprime con lz4 (0 = no negociar lz4)')
+    parser.add_argument('--handshake-timeout', type=float, default=HANDSHAKE_TIMEOUT,
+                        help='segundos para completar el handshake antes de cortar (0 = sin límite)')
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help="segundos sin recibir nada antes de enviar 'ping' (0 = sin heartbeats)")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='segundos sin recibir nada antes de cortar una sesión con heartbeat (0 = nunca)')
+    parser.add_argument('--max-file-size', type=int, default=MAX_FILE_SIZE,
+                        help='bytes máximos por archivo compartido y en curso por emisor (0 = sin transferencias)')
+    parser.add_argument('--max-transfers', type=int, default=MAX_TRANSFERS,
+                        help='transferencias de archivos simultáneas por emisor')
+    parser.add_argument('--rate-limit', type=float, default=DEFAULT_RATE,
+                        help='mensajes de chat por segundo de cada participante (por defecto 0 = sin límite)')
+    parser.add_argument('--rate-burst', type=int, default=DEFAULT_BURST,
+                        help='mensajes que un participante puede enviar de golpe')
+    parser.add_argument('--rate-max-delay', type=float, default=DEFAULT_MAX_DELAY,
+                        help='segundos que se difiere un mensaje fuera de ritmo antes de rechazarlo')
+    parser.add_argument('--max-pending', type=int, default=MAX_PENDING,
+                        help='mensajes de un participante esperando turno antes de rechazar los siguientes')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='procesos que comparten el puerto con SO_REUSEPORT (Linux/BSD)')
+    return parser.parse_args(argv)
+
+
+def build_server(args, **extra):
+    options = {
+        'host': args.host,
+        'port': args.port,
+        'outbound_maxsize': args.outbound_queue,
+        'outbound_max_bytes': args.outbound_bytes,
+        'slow_consumer_policy': args.slow_consumer,
+        'handshake_timeout': args.handshake_timeout,
+        'heartbeat_interval': args.heartbeat_interval,
+        'idle_timeout': args.idle_timeout,
+        'max_file_size': args.max_file_size,
+        'max_transfers': args.max_transfers,
+        'rate_limit': args.rate_limit,
+        'rate_burst': args.rate_burst,
+        'rate_max_delay': args.rate_max_delay,
+        'max_pending': args.max_pending,
+        'handshake_pool': HandshakePool(
+            workers=args.handshake_workers,
+            max_pending=args.handshake_queue,
+            max_wait=args.handshake_max_wait,
+            kind=args.handshake_pool
+        ),
+        'tickets': TicketCache(max_entries=args.ticket_cache, lifetime=args.ticket_lifetime),
+        'group_keys': args.group_keys,
+        'history_replay': args.history_replay,
+        'compress_threshold': args.compress_threshold,
+    }
+    if args.history_dir:
+        options['history'] = HistoryStore(
+            args.history_dir,
+            segment_size=args.history_segment_size,
+            retention_segments=args.history_retention,
+            retention_seconds=args.history_max_age
+        )
+    if args.backlog:
+        options['backlog'] = args.backlog
+    options.update(extra)
+
+    if args.engine == 'asyncio':
+        from async_server import AsyncSecureChatServer
+        return AsyncSecureChatServer(**options)
+    return SecureChatServer(**options)
+
+
+def run_server(args, index=0, **extra):
+    server = build_server(args, **extra)
+    if args.stats_interval:
+        server.start_stats_logger(args.stats_interval)
+    if args.metrics_port:
+        metrics_port = args.metrics_port + index
+        start_http_server(metrics_port, args.host)
+        print(f'[+] Metricas en http://{args.host}:{metrics_port}/metrics')
+    server.start_server()
+
+
+def start_worker(args, index, bus_path):
+    from cluster import BusClient
+    if args.history_dir:
+        # Cada worker guarda todo el historial (propio y del bus) en su directorio
+        args.history_dir = os.path.join(args.history_dir, f'worker-{index}')
+    run_server(args, index, reuse_port=True, bus=BusClient(bus_path, index))
 
 
 if __name__ == "__main__":
-    server = SecureChatServer()
-    server.start_server()
\ No newline at end of file
+    args = parse_args()
+    if args.workers > 1:
+        from cluster import run_cluster
+        run_cluster(args.workers, lambda index, bus_path: start_worker(args, index, bus_path))
+    else:
+        run_server(args)
@@ -0,0 +1,48 @@
+"""Registro compacto de una sesión del servidor.
+
+Un solo objeto con __slots__ guarda el estado criptográfico de la sesión y
+el de su conexión (cola de salida, sala, capacidades). Las tablas del
+servidor (sessions, clients, gateways) apuntan al mismo registro por
+session_id.
+"""
+import time
+
+
+class Session:
+    __slots__ = (
+        'session_id', 'session_key', 'last_nonce', 'start_time', 'resumed', 'features',
+        'connection', 'address', 'nonce_counter', 'outbound', 'room',
+        'gateway', 'member', 'members',
+        'group_keys', 'group_epoch', 'compression',
+        'presence', 'transfers', 'last_seen', 'pinged', 'timer',
+        'bucket', 'pending',
+    )
+
+    def __init__(self, session_id, session_key=None, resumed=False):
+        self.session_id = session_id
+        self.session_key = session_key
+        self.last_nonce = 0  # Último nonce aceptado del cliente (anti-replay)
+        self.start_time = time.time()
+        self.resumed = resumed
+        self.features = set()  # Capacidades negociadas con 'hello'
+        self.connection = None
+        self.address = None
+        self.nonce_counter = 0  # Nonce de los mensajes que le envía el servidor
+        self.outbound = None
+        self.room = None
+        self.gateway = None  # session_id del gateway si es un usuario multiplexado
+        self.member = None  # Id del usuario dentro de su gateway
+        self.members = None  # Solo gateways: usuario -> session_id
+        self.group_keys = False  # Negociado con 'hello'
+        self.group_epoch = None  # Última clave de sala que se le envió
+        self.compression = False  # lz4, negociado con 'hello'
+        self.presence = False  # Recibe la lista de su sala y sus deltas
+        self.transfers = None  # Id -> RelayTransfer que llegan por esta conexión
+        self.last_seen = time.monotonic()  # Último mensaje recibido
+        self.pinged = False  # Se le envió 'ping' y no respondió todavía
+        self.timer = None  # Temporizador de heartbeat/inactividad en la rueda
+        self.bucket = None  # TokenBucket de sus mensajes de chat
+        self.pending = None  # Mensajes admitidos que esperan su turno en el planificador
+
+    def __repr__(self):
+        return f'<Session {self.session_id.hex()} {self.address}>'
@@ -10,6 +10,8 @@ const joinBtn = document.getElementById('join-btn');
 const chatMessages = document.getElementById('chat-messages');
 const messageInput = document.getElementById('message-input');
 const sendBtn = document.getElementById('send-btn');
+const attachBtn = document.getElementById('attach-btn');
+const fileInput = document.getElementById('file-input');
 const statusEl = document.getElementById('status');
 
 // Unirse al chat
@@ -46,9 +48,14 @@ socket.on('join_error', (data) => {
     alert(data.message);
 });
 
-// Nuevo mensaje
-socket.on('new_message', (data) => {
-    addMessage(data.message, false);
+// Mensajes nuevos: el servidor web los agrupa en lotes
+socket.on('new_messages', (data) => {
+    const fragment = document.createDocumentFragment();
+    data.messages.forEach((text) => {
+        fragment.appendChild(createMessage(text, false));
+    });
+    chatMessages.appendChild(fragment);
+    chatMessages.scrollTop = chatMessages.scrollHeight;
 });
 
 // Aviso de desconexión
@@ -78,8 +85,42 @@ messageInput.addEventListener('keypress', (e) => {
     }
 });
 
+// Compartir archivo: se sube por HTTP y el servidor web lo envía en trozos
+attachBtn.addEventListener('click', () => {
+    if (connected) {
+        fileInput.click();
+    }
+});
+
+fileInput.addEventListener('change', () => {
+    const file = fileInput.files[0];
+    fileInput.value = '';
+    if (!file) {
+        return;
+    }
+    const form = new FormData();
+    form.append('sid', socket.id);
+    form.append('file', file);
+    addSystemMessage(`Enviando ${file.name}...`);
+    fetch('/upload', { method: 'POST', body: form })
+        .then((response) => response.json().then((data) => {
+            if (response.ok) {
+                addSystemMessage(`${data.name} enviado a ${data.recipients} usuario(s)`);
+            } else {
+                addSystemMessage(data.error);
+            }
+        }))
+        .catch(() => addSystemMessage(`Error enviando ${file.name}`));
+});
+
 // Agregar mensaje al chat
 function addMessage(text, isOwn = false) {
+    chatMessages.appendChild(createMessage(text, isOwn));
+    chatMessages.scrollTop = chatMessages.scrollHeight;
+}
+
+// Crear el elemento de un mensaje
+function createMessage(text, isOwn = false) {
     const messageDiv = document.createElement('div');
     messageDiv.className = `message ${isOwn ? 'own' : ''}`;
     
@@ -100,9 +141,7 @@ function addMessage(text, isOwn = false) {
     contentDiv.appendChild(timeSpan);
     contentDiv.appendChild(textDiv);
     messageDiv.appendChild(contentDiv);
-    
-    chatMessages.appendChild(messageDiv);
-    chatMessages.scrollTop = chatMessages.scrollHeight;
+    return messageDiv;
 }
 
 // Agregar mensaje del sistema
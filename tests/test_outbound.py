@@ -0,0 +1,54 @@
+from outbound import DISCONNECT, DROP_NEWEST, DROP_OLDEST, OutboundQueue
+
+
+class QuietQueue(OutboundQueue):
+    """Cola sin escritor: los tests miran lo que queda encolado"""
+
+    def _wakeup(self):
+        pass
+
+
+def pending(queue):
+    return [item for item, _ in queue.items]
+
+
+def test_drop_oldest_keeps_newest_after_repeated_overflows():
+    queue = QuietQueue(lambda item: item, maxsize=4, policy=DROP_OLDEST)
+    for n in range(20):
+        assert queue.put(f'm{n}'.encode())
+    assert pending(queue) == [b'm16', b'm17', b'm18', b'm19']
+    assert not any(essential for _, essential in queue.items)
+    assert queue.dropped == 16
+
+
+def test_drop_oldest_keeps_essential_messages():
+    queue = QuietQueue(lambda item: item, maxsize=2, policy=DROP_OLDEST)
+    assert queue.put(b'welcome', essential=True)
+    for n in range(5):
+        assert queue.put(f'm{n}'.encode())
+    assert pending(queue) == [b'welcome', b'm4']
+
+
+def test_drop_oldest_respects_byte_limit():
+    queue = QuietQueue(lambda item: item, maxsize=100, policy=DROP_OLDEST, max_bytes=10)
+    for n in range(10):
+        assert queue.put(b'%05d' % n)
+    assert pending(queue) == [b'00008', b'00009']
+    assert queue.queued_bytes == 10
+
+
+def test_drop_newest_discards_incoming():
+    queue = QuietQueue(lambda item: item, maxsize=2, policy=DROP_NEWEST)
+    assert queue.put(b'a') and queue.put(b'b')
+    assert not queue.put(b'c')
+    assert queue.put(b'welcome', essential=True)
+    assert pending(queue) == [b'a', b'b', b'welcome']
+
+
+def test_disconnect_fails_once():
+    reasons = []
+    queue = QuietQueue(lambda item: item, maxsize=1, policy=DISCONNECT, on_failure=reasons.append)
+    assert queue.put(b'a')
+    assert not queue.put(b'b')
+    assert not queue.put(b'c')
+    assert reasons == ['cola de salida llena']
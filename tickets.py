@@ -0,0 +1,62 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from cipher import hkdf
+
+TICKET_ID_SIZE = 16
+DEFAULT_TICKET_LIFETIME = 3600  # segundos
+DEFAULT_TICKET_CACHE_SIZE = 10000
+
+
+def ticket_secret(session_key, ticket_id):
+    """Secreto de reanudación ligado a la sesión que emitió el ticket.
+
+    Cliente y servidor lo calculan por su cuenta: nunca viaja por la red.
+    """
+    return hkdf(session_key, ticket_id, b'chat-seguro ticket')
+
+
+def resumed_session_key(secret, salt, client_nonce, server_nonce):
+    """Clave de la sesión reanudada: HKDF en lugar de 100.000 iteraciones de PBKDF2"""
+    return hkdf(secret, salt + client_nonce + server_nonce, b'chat-seguro resume')
+
+
+class TicketCache:
+    """Tickets de reanudación emitidos, con caducidad y tamaño acotado (LRU).
+
+    Cada ticket sirve una sola vez: al canjearlo se elimina y la sesión
+    reanudada recibe uno nuevo.
+    """
+
+    def __init__(self, max_entries=DEFAULT_TICKET_CACHE_SIZE, lifetime=DEFAULT_TICKET_LIFETIME):
+        self.max_entries = max_entries
+        self.lifetime = lifetime
+        self.entries = OrderedDict()  # ticket_id -> (secreto, expira)
+        self.lock = threading.Lock()
+
+    def issue(self, session_key):
+        """Emite un ticket para la sesión. Devuelve (ticket_id, vida en segundos)"""
+        ticket_id = os.urandom(TICKET_ID_SIZE)
+        expires_at = time.monotonic() + self.lifetime
+        with self.lock:
+            self.entries[ticket_id] = (ticket_secret(session_key, ticket_id), expires_at)
+            # Se descartan los tickets menos usados recientemente
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return ticket_id, self.lifetime
+
+    def redeem(self, ticket_id):
+        """Consume un ticket. Devuelve su secreto o None si no existe o caducó"""
+        with self.lock:
+            entry = self.entries.pop(ticket_id, None)
+        if entry is None:
+            return None
+        secret, expires_at = entry
+        if expires_at < time.monotonic():
+            return None
+        return secret
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,73 @@
+"""Rueda de temporizadores con hash para heartbeats y timeouts.
+
+Cada temporizador cae en la ranura de su tick de vencimiento módulo el
+número de ranuras: programar y cancelar son O(1) y cada tick solo mira su
+ranura, sin recorrer todas las conexiones.
+"""
+import math
+import threading
+
+DEFAULT_TICK = 1.0
+DEFAULT_SLOTS = 512
+
+
+class Timer:
+    __slots__ = ('deadline', 'slot', 'callback', 'args')
+
+    def __init__(self, deadline, slot, callback, args):
+        self.deadline = deadline  # Tick absoluto en el que vence
+        self.slot = slot  # None si ya venció o se canceló
+        self.callback = callback
+        self.args = args
+
+
+class TimerWheel:
+    """Temporizadores con resolución de un tick.
+
+    advance() lo llama el motor una vez por tick (un hilo o el event loop) y
+    ejecuta los callbacks vencidos fuera del lock.
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]  # Timer -> None (conjunto ordenado)
+        self.current = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, callback, *args):
+        """Ejecuta callback(*args) dentro de delay segundos (redondeado al tick)"""
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self.lock:
+            deadline = self.current + ticks
+            slot = deadline % len(self.slots)
+            timer = Timer(deadline, slot, callback, args)
+            self.slots[slot][timer] = None
+        return timer
+
+    def cancel(self, timer):
+        if timer is None:
+            return
+        with self.lock:
+            if timer.slot is not None:
+                self.slots[timer.slot].pop(timer, None)
+                timer.slot = None
+
+    def advance(self):
+        """Avanza un tick y ejecuta los temporizadores vencidos"""
+        with self.lock:
+            self.current += 1
+            bucket = self.slots[self.current % len(self.slots)]
+            # Los de vueltas posteriores comparten ranura pero aún no vencen
+            expired = [timer for timer in bucket if timer.deadline <= self.current]
+            for timer in expired:
+                del bucket[timer]
+                timer.slot = None
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                print(f'[-] Error en temporizador: {e}')
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(bucket) for bucket in self.slots)
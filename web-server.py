@@ -1,48 +1,145 @@
-from flask import Flask, render_template, request, jsonify
+import os
+
+# Modo producción: eventlet atiende todos los websockets y las conexiones con
+# el servidor de chat como green threads. monkey_patch() debe ejecutarse
+# antes de importar socket y threading
+WEB_MODE = os.environ.get('CHAT_WEB_MODE', 'development')
+if WEB_MODE == 'production':
+    import eventlet
+    eventlet.monkey_patch()
+
+from flask import Flask, Response, render_template, request, jsonify
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import socket
-import hashlib
-import hmac
-import os
 import threading
 import time
 
+from cipher import MASTER_KEY, derive_key, seal, unseal
+from compression import FEATURE as LZ4_FEATURE
+from compression import available as lz4_available, compress_payload, decompress_payload
+from filetransfer import FEATURE as FILE_FEATURE, MAX_FILE_SIZE, OutgoingTransfer, safe_name, stream_file
+from framing import FrameDecoder, RECV_SIZE, encode_frame, recv_exact
+from handshake import BUSY_MARKER, GATEWAY_MARKER, HANDSHAKE_TIMEOUT
+from metrics import CONTENT_TYPE, REGISTRY, STAGE_SECONDS
+from protocol import decode_control, encode_control
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'tu_clave_secreta_aqui_2024'
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Werkzeug guarda las subidas grandes en un temporal; el resto del formulario es pequeño
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE + 64 * 1024
+socketio = SocketIO(app, cors_allowed_origins="*",
+                    async_mode='eventlet' if WEB_MODE == 'production' else 'threading')
+
+# Servidor de chat y tamaño del pool de conexiones compartidas
+CHAT_SERVER_HOST = os.environ.get('CHAT_SERVER_HOST', '127.0.0.1')
+CHAT_SERVER_PORT = int(os.environ.get('CHAT_SERVER_PORT', 65432))
+UPSTREAM_POOL_SIZE = int(os.environ.get('CHAT_UPSTREAM_POOL', 4))
+
+# Intentos de reconexión de una conexión del pool antes de avisar a sus usuarios
+RECONNECT_ATTEMPTS = 5
 
-# Almacena las conexiones activas de cada usuario web
+# Los mensajes de cada usuario se agrupan y se emiten juntos cada tick (segundos)
+EMIT_TICK = float(os.environ.get('CHAT_EMIT_TICK', 0.02))
+
+# Puente de cada usuario web activo
 active_connections = {}
 
+GATEWAY_SENT = REGISTRY.counter('chat_gateway_controls_sent_total',
+                                'Controles enviados al servidor de chat', ['type'])
+GATEWAY_RELAYS = REGISTRY.counter('chat_gateway_relays_total',
+                                  'Relays recibidos del servidor de chat')
+GATEWAY_EMITS = REGISTRY.counter('chat_gateway_emits_total',
+                                 'Usuarios web alcanzados por los relays')
+GATEWAY_BATCHES = REGISTRY.counter('chat_gateway_batches_total',
+                                   'Eventos new_messages emitidos a los usuarios web')
+UNSEAL_STAGE = STAGE_SECONDS.labels('gateway_unseal')
+EMIT_STAGE = STAGE_SECONDS.labels('gateway_emit')
+SEND_STAGE = STAGE_SECONDS.labels('gateway_send')
+REGISTRY.gauge('chat_gateway_users', 'Usuarios web unidos al chat',
+               function=lambda: len(active_connections))
+
+class EmitBatcher:
+    """Agrupa los mensajes pendientes de cada usuario web durante un tick.
+
+    En una ráfaga, cada usuario recibe un solo evento 'new_messages' con
+    todos sus mensajes en lugar de un evento por mensaje. Los usuarios con
+    el mismo lote comparten una sola emisión.
+    """
+    
+    def __init__(self, tick=EMIT_TICK):
+        self.tick = tick
+        self.pending = {}  # user_id -> [mensajes]
+        self.scheduled = False
+        self.lock = threading.Lock()
+    
+    def add(self, users, text):
+        with self.lock:
+            for user in users:
+                self.pending.setdefault(user, []).append(text)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        socketio.start_background_task(self.flush_later)
+    
+    def flush_later(self):
+        socketio.sleep(self.tick)
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.scheduled = False
+        
+        started = time.perf_counter()
+        batches = {}
+        for user, messages in pending.items():
+            batches.setdefault(tuple(messages), []).append(user)
+        for messages, users in batches.items():
+            socketio.emit('new_messages', {'messages': list(messages)}, to=users)
+            GATEWAY_EMITS.inc(len(users))
+        GATEWAY_BATCHES.inc(len(batches))
+        EMIT_STAGE.observe(time.perf_counter() - started)
+
+emit_batcher = EmitBatcher()
+
 class ChatClientBridge:
-    """Puente entre el cliente web y el servidor de chat seguro"""
+    """Conexión compartida entre el servidor web y el servidor de chat seguro.
+
+    Multiplexa a varios usuarios web sobre un solo socket y una sola sesión:
+    se presenta como gateway y envía los mensajes de cada usuario con su id.
+    Un único hilo lector reparte lo recibido a las salas de Socket.IO.
+    """
     
-    def __init__(self, user_id, chat_server_host='127.0.0.1', chat_server_port=65432):
-        self.user_id = user_id
+    def __init__(self, index, chat_server_host=CHAT_SERVER_HOST, chat_server_port=CHAT_SERVER_PORT):
+        self.index = index
         self.chat_server_host = chat_server_host
         self.chat_server_port = chat_server_port
         self.session_key = None
         self.nonce_counter = 0
         self.conn = None
+        self.connected = False
         self.receiving = True
+        self.users = {}  # user_id -> username
+        self.compression = False  # El servidor aceptó lz4 en 'welcome'
+        self.compression_offered = False  # Anunció lz4 en 'hello'; cuenta hasta 'welcome'
+        self.welcomed = False
+        self.files = False  # El servidor aceptó 'files' en 'welcome'
+        self.max_file_size = 0
+        self.uploads = {}  # id -> OutgoingTransfer de las subidas en curso
+        self.send_lock = threading.Lock()
+        self.reader = None
         
-    def vernam_encrypt_decrypt(self, data, key):
-        return bytes([data[i] ^ key[i % len(key)] for i in range(len(data))])
-    
-    def derive_key(self, password, salt):
-        return hashlib.pbkdf2_hmac('sha256', password, salt, 100000, 32)
-    
     def establish_secure_session(self):
         try:
-            salt = self.conn.recv(16)
+            salt = recv_exact(self.conn, 16)
             client_nonce = os.urandom(16)
-            self.conn.send(client_nonce)
-            server_nonce = self.conn.recv(16)
+            self.conn.sendall(GATEWAY_MARKER + client_nonce)
+            server_nonce = recv_exact(self.conn, 16)
+            if server_nonce == BUSY_MARKER:
+                print('Servidor de chat ocupado, conexión rechazada')
+                return False
             
-            master_key = b'Luciernagas_GlobalFinance_2024'
-            self.session_key = self.derive_key(master_key, salt + client_nonce + server_nonce)
+            self.session_key = derive_key(MASTER_KEY, salt + client_nonce + server_nonce)
+            self.nonce_counter = 0
             
-            session_id = self.conn.recv(8)
+            session_id = recv_exact(self.conn, 8)
             return True
         except Exception as e:
             print(f'Error estableciendo sesión: {e}')
@@ -50,85 +147,273 @@ class ChatClientBridge:
     
     def encrypt_message(self, message):
         self.nonce_counter += 1
-        encrypted = self.vernam_encrypt_decrypt(message, self.session_key)
-        message_hmac = hmac.new(self.session_key, encrypted, hashlib.sha256).digest()
-        nonce_bytes = self.nonce_counter.to_bytes(8, 'big')
-        return nonce_bytes + message_hmac + encrypted
+        if self.compression:
+            message = compress_payload(message)
+        return encode_frame(seal(message, self.session_key, self.nonce_counter))
     
     def decrypt_message(self, encrypted_data):
-        if len(encrypted_data) < 40:
+        opened = unseal(encrypted_data, self.session_key)
+        if opened is None:
             return None
-        
-        received_hmac = encrypted_data[8:40]
-        encrypted_message = encrypted_data[40:]
-        
-        expected_hmac = hmac.new(self.session_key, encrypted_message, hashlib.sha256).digest()
-        if not hmac.compare_digest(expected_hmac, received_hmac):
+        # Como en el cliente: solo se descomprime si la sesión negoció lz4
+        negotiated = self.compression if self.welcomed else self.compression_offered
+        if not negotiated:
+            return opened[1]
+        try:
+            return decompress_payload(opened[1])
+        except ValueError:
             return None
-        
-        return self.vernam_encrypt_decrypt(encrypted_message, self.session_key)
+    
+    def send_control(self, kind, **fields):
+        # Varios usuarios escriben a la vez: el nonce y el envío van juntos
+        started = time.perf_counter()
+        with self.send_lock:
+            self.conn.sendall(self.encrypt_message(encode_control(kind, **fields)))
+        SEND_STAGE.observe(time.perf_counter() - started)
+        GATEWAY_SENT.labels(kind).inc()
+    
+    def send_chunk(self, chunk):
+        with self.send_lock:
+            self.conn.sendall(self.encrypt_message(chunk))
+    
+    def route(self, control):
+        """Entrega un 'relay' del servidor a los usuarios web indicados"""
+        if control['type'] == 'welcome':
+            self.compression = LZ4_FEATURE in control.get('features', [])
+            self.welcomed = True
+            self.files = FILE_FEATURE in control.get('features', [])
+            self.max_file_size = control.get('max_file_size', 0)
+            return
+        if control['type'] in ('file_ack', 'file_done', 'file_abort'):
+            transfer = self.uploads.get(bytes.fromhex(control['id']))
+            if transfer is None:
+                return
+            if control['type'] == 'file_ack':
+                transfer.ack(control['seq'])
+            elif control['type'] == 'file_done':
+                transfer.finished(control['recipients'])
+            else:
+                transfer.abort(control.get('reason', 'cancelado'))
+            return
+        if control['type'] == 'ping':
+            self.send_control('pong')
+            return
+        if control['type'] != 'relay':
+            return
+        GATEWAY_RELAYS.inc()
+        users = [user for user in control.get('users', []) if user in self.users]
+        if users and 'text' in control:
+            emit_batcher.add(users, control['text'])
     
     def receive_messages(self):
-        """Hilo que recibe mensajes del servidor de chat y los envía al cliente web"""
+        """Hilo que recibe mensajes del servidor de chat y los reparte a los usuarios web"""
+        decoder = FrameDecoder()
         while self.receiving:
             try:
-                data = self.conn.recv(1024)
+                data = self.conn.recv(RECV_SIZE)
                 if not data:
-                    socketio.emit('disconnect_notice', 
-                                {'message': 'Conexión perdida con el servidor'}, 
-                                room=self.user_id)
-                    break
+                    raise ConnectionError('conexión cerrada por el servidor')
                 
-                decrypted = self.decrypt_message(data)
-                if decrypted:
-                    message = decrypted.decode('utf-8')
-                    # Enviar mensaje al cliente web vía WebSocket
-                    socketio.emit('new_message', {'message': message}, room=self.user_id)
+                for frame in decoder.feed(data):
+                    started = time.perf_counter()
+                    decrypted = self.decrypt_message(frame)
+                    UNSEAL_STAGE.observe(time.perf_counter() - started)
+                    if decrypted:
+                        control = decode_control(decrypted)
+                        if control is not None:
+                            self.route(control)
                     
             except socket.timeout:
                 continue
             except Exception as e:
-                if self.receiving:
-                    print(f'Error recibiendo mensaje: {e}')
-                break
+                if not self.receiving:
+                    break
+                print(f'Conexión {self.index} con el servidor de chat perdida: {e}')
+                if not self.reconnect():
+                    break
+                decoder = FrameDecoder()
+        
+        self.connected = False
+        # Este hilo termina: si el pool vuelve a conectar esta conexión, necesita otro lector
+        self.reader = None
+        if self.receiving:
+            self.move_users()
+    
+    def move_users(self):
+        """Tras agotar los reintentos, pasa sus usuarios a otra conexión del pool"""
+        users, self.users = self.users, {}
+        available = True
+        for user_id, username in users.items():
+            if active_connections.get(user_id) is not self:
+                continue
+            bridge = bridge_pool.acquire() if available else None
+            if bridge and bridge.attach(user_id, username):
+                active_connections[user_id] = bridge
+                continue
+            available = False
+            active_connections.pop(user_id, None)
+            socketio.emit('disconnect_notice',
+                          {'message': 'Conexión perdida con el servidor'},
+                          to=user_id)
     
     def connect(self):
         try:
             self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.conn.settimeout(1.0)
+            # La derivación puede esperar en la cola de handshakes del servidor
+            self.conn.settimeout(HANDSHAKE_TIMEOUT)
             self.conn.connect((self.chat_server_host, self.chat_server_port))
             
             if not self.establish_secure_session():
+                self.conn.close()
                 return False
+            self.conn.settimeout(1.0)
+            self.compression = False
+            self.welcomed = False
+            self.files = False
+            # Heartbeat: el servidor corta las conexiones que dejan de responder
+            features = ['heartbeat']
+            self.compression_offered = lz4_available()
+            if self.compression_offered:
+                # Los relays grandes (pegados de logs, código) viajan comprimidos
+                features.append(LZ4_FEATURE)
+            # Subidas desde la web; los usuarios web no reciben archivos
+            features.append(FILE_FEATURE)
+            self.send_control('hello', features=features)
+            self.connected = True
             
-            # Iniciar hilo de recepción
-            receive_thread = threading.Thread(target=self.receive_messages)
-            receive_thread.daemon = True
-            receive_thread.start()
+            # Un solo hilo de recepción por conexión, no por usuario
+            if self.reader is None or not self.reader.is_alive():
+                self.reader = threading.Thread(target=self.receive_messages)
+                self.reader.daemon = True
+                self.reader.start()
             
             return True
         except Exception as e:
             print(f'Error conectando: {e}')
             return False
     
-    def send_message(self, message):
+    def reconnect(self):
+        """Restablece la conexión y vuelve a registrar a sus usuarios"""
+        self.connected = False
+        self.conn.close()
+        for attempt in range(RECONNECT_ATTEMPTS):
+            time.sleep(min(2 ** attempt, 10))
+            if self.connect():
+                try:
+                    for user_id, username in list(self.users.items()):
+                        self.send_control('attach', user=user_id, name=username)
+                    return True
+                except OSError:
+                    self.conn.close()
+        return False
+    
+    def attach(self, user_id, username):
+        self.users[user_id] = username
         try:
-            encrypted = self.encrypt_message(message.encode('utf-8'))
-            self.conn.send(encrypted)
+            self.send_control('attach', user=user_id, name=username)
+            return True
+        except Exception as e:
+            print(f'Error registrando usuario: {e}')
+            del self.users[user_id]
+            return False
+    
+    def detach(self, user_id):
+        if self.users.pop(user_id, None) is not None and self.connected:
+            try:
+                self.send_control('detach', user=user_id)
+            except OSError:
+                pass
+    
+    def send_message(self, user_id, message):
+        try:
+            self.send_control('say', user=user_id, text=message)
             return True
         except Exception as e:
             print(f'Error enviando mensaje: {e}')
             return False
     
+    def send_file(self, user_id, name, size, stream):
+        """Comparte un archivo en nombre de un usuario web, trozo a trozo y con ventana.
+
+        Devuelve la transferencia: recipients queda en None si no terminó,
+        con el motivo en error.
+        """
+        transfer = OutgoingTransfer(safe_name(name), size)
+        transfer_id = transfer.transfer_id.hex()
+        self.uploads[transfer.transfer_id] = transfer
+        try:
+            self.send_control('file_offer', user=user_id, id=transfer_id, name=transfer.name, size=size)
+            sha256 = stream_file(transfer, stream, self.send_chunk)
+            if sha256 is None:
+                self.send_control('file_abort', user=user_id, id=transfer_id)
+            else:
+                self.send_control('file_end', user=user_id, id=transfer_id, sha256=sha256)
+                transfer.wait_finished()
+        except OSError as e:
+            transfer.abort(str(e))
+        finally:
+            self.uploads.pop(transfer.transfer_id, None)
+        if transfer.recipients is None and transfer.error is None:
+            transfer.error = 'sin confirmación del servidor'
+        return transfer
+    
     def disconnect(self):
         self.receiving = False
+        self.connected = False
         if self.conn:
             self.conn.close()
 
+class BridgePool:
+    """Pool pequeño de conexiones largas con el servidor de chat"""
+    
+    def __init__(self, size=UPSTREAM_POOL_SIZE):
+        self.bridges = [ChatClientBridge(index) for index in range(size)]
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Devuelve la conexión con menos usuarios, conectándola si hace falta"""
+        with self.lock:
+            for bridge in sorted(self.bridges, key=lambda b: len(b.users)):
+                if bridge.connected or bridge.connect():
+                    return bridge
+        return None
+
+bridge_pool = BridgePool()
+
+REGISTRY.gauge('chat_gateway_upstreams_connected', 'Conexiones activas con el servidor de chat',
+               function=lambda: sum(1 for bridge in bridge_pool.bridges if bridge.connected))
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@app.route('/upload', methods=['POST'])
+def upload():
+    """Comparte un archivo con la sala del usuario web indicado por su sid"""
+    user_id = request.form.get('sid', '')
+    bridge = active_connections.get(user_id)
+    if bridge is None:
+        return jsonify({'error': 'No estás conectado al chat'}), 403
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({'error': 'Falta el archivo'}), 400
+    if not bridge.files:
+        return jsonify({'error': 'El servidor de chat no acepta archivos'}), 503
+    stream = upload.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    if size > bridge.max_file_size:
+        return jsonify({'error': f'El archivo supera el máximo de {bridge.max_file_size} bytes'}), 413
+    transfer = bridge.send_file(user_id, upload.filename, size, stream)
+    if transfer.recipients is None:
+        return jsonify({'error': f'Envío cancelado: {transfer.error}'}), 502
+    return jsonify({'name': transfer.name, 'recipients': transfer.recipients})
+
 @socketio.on('connect')
 def handle_connect():
     user_id = request.sid
@@ -139,10 +424,10 @@ def handle_join_chat(data):
     user_id = request.sid
     username = data.get('username', f'Usuario_{user_id[:8]}')
     
-    # Crear puente de conexión con el servidor de chat
-    bridge = ChatClientBridge(user_id)
+    # Usar una de las conexiones compartidas con el servidor de chat
+    bridge = bridge_pool.acquire()
     
-    if bridge.connect():
+    if bridge and bridge.attach(user_id, username):
         active_connections[user_id] = bridge
         join_room(user_id)
         emit('join_success', {'message': f'Conectado como {username}'})
@@ -157,7 +442,7 @@ def handle_send_message(data):
     
     if user_id in active_connections:
         bridge = active_connections[user_id]
-        if bridge.send_message(message):
+        if bridge.send_message(user_id, message):
             # El mensaje se mostrará cuando el servidor lo reenvíe
             pass
         else:
@@ -169,12 +454,16 @@ def handle_send_message(data):
 def handle_disconnect():
     user_id = request.sid
     if user_id in active_connections:
-        active_connections[user_id].disconnect()
-        del active_connections[user_id]
+        active_connections.pop(user_id).detach(user_id)
         leave_room(user_id)
     print(f'Usuario web desconectado: {user_id}')
 
 if __name__ == '__main__':
     print('[+] Servidor web iniciando en http://localhost:5000')
-    print('[+] Asegúrate de que el servidor de chat esté corriendo en el puerto 65432')
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True, allow_unsafe_werkzeug=True)
\ No newline at end of file
+    print(f'[+] Asegúrate de que el servidor de chat esté corriendo en el puerto {CHAT_SERVER_PORT}')
+    print(f'[+] Usuarios web multiplexados sobre {UPSTREAM_POOL_SIZE} conexiones con el servidor de chat')
+    if WEB_MODE == 'production':
+        print('[+] Modo produccion: eventlet')
+        socketio.run(app, host='0.0.0.0', port=5000)
+    else:
+        socketio.run(app, host='0.0.0.0', port=5000, debug=True, allow_unsafe_werkzeug=True)
\ No newline at end of file